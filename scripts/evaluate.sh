@@ -2,4 +2,4 @@
 
 DATASET_NAME=semeval2016
 
-poetry run python src/inference.py --dataset_name $DATASET_NAME
\ No newline at end of file
+poetry run python src/inference.py --dataset_name $DATASET_NAME --cache_path data/completion_cache.sqlite
\ No newline at end of file
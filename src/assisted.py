@@ -0,0 +1,137 @@
+import time
+
+
+def load_draft_model(draft_model_id, model):
+    from transformers import AutoModelForCausalLM
+
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_model_id, torch_dtype="auto")
+    return draft_model.to(model.device).eval()
+
+
+class AssistedDecodingStats:
+    """Forward passes and time of the target and the draft model in assisted generate calls.
+
+    Every verification pass of the target keeps the draft tokens it accepts and adds one token of its
+    own, so the accepted draft tokens are the generated tokens minus the target passes. Each draft
+    forward pass proposes one token.
+
+    The speedup is measured: every `reference_every`-th call is also run without the draft, with the
+    random state restored afterwards so the sampled outputs do not change, and the time per generated
+    token of those reference calls is compared with that of the same calls assisted. Until a reference
+    exists it is estimated from the target passes: the first pass of a call runs over the whole prompt
+    (prefill, which also yields the first token) and every further token is priced at the mean time of
+    the later passes. Those verify several tokens at once, so the estimate is an upper bound.
+    """
+
+    def __init__(self, model, draft_model, reference_every=20):
+        import torch
+
+        self.reference_every = reference_every
+        self.calls = 0
+        self.generated_tokens = 0
+        self.target_forwards = 0
+        self.draft_forwards = 0
+        self.prefill_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.decode_forwards = 0
+        self.generate_seconds = 0.0
+        # the calls that were also run without the draft: (seconds, tokens) assisted and unassisted
+        self.reference = {"assisted": [0.0, 0], "unassisted": [0.0, 0]}
+        self.reference_calls = 0
+        self.active = False
+        self.prefilled = False
+        self.started = {}
+
+        model.register_forward_pre_hook(lambda module, inputs: self.start("target"))
+        model.register_forward_hook(lambda module, inputs, output: self.stop("target"))
+        draft_model.register_forward_hook(lambda module, inputs, output: self.count_draft())
+
+        generate = model.generate
+
+        def timed_generate(args, kwargs):
+            start = time.perf_counter()
+            outputs = generate(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            sequences = outputs if hasattr(outputs, "shape") else outputs.sequences
+            input_ids = kwargs["input_ids"] if "input_ids" in kwargs else args[0]
+            return outputs, seconds, sequences.shape[-1] - input_ids.shape[-1]
+
+        def counted_generate(*args, **kwargs):
+            if "assistant_model" not in kwargs:
+                return generate(*args, **kwargs)
+
+            if self.calls % self.reference_every == 0:
+                unassisted = {k: v for k, v in kwargs.items() if k != "assistant_model"}
+                devices = [model.device] if model.device.type == "cuda" else []
+                with torch.random.fork_rng(devices=devices):
+                    _, seconds, tokens = timed_generate(args, unassisted)
+                self.add_reference("unassisted", seconds, tokens)
+                reference = True
+            else:
+                reference = False
+
+            self.active, self.prefilled = True, False
+            try:
+                outputs, seconds, tokens = timed_generate(args, kwargs)
+            finally:
+                self.active = False
+            self.calls += 1
+            self.generate_seconds += seconds
+            self.generated_tokens += tokens
+            if reference:
+                self.add_reference("assisted", seconds, tokens)
+                self.reference_calls += 1
+            return outputs
+
+        model.generate = counted_generate
+
+    def add_reference(self, name, seconds, tokens):
+        self.reference[name][0] += seconds
+        self.reference[name][1] += tokens
+
+    def start(self, name):
+        if self.active:
+            self.started[name] = time.perf_counter()
+
+    def stop(self, name):
+        if self.active and name in self.started:
+            seconds = time.perf_counter() - self.started.pop(name)
+            self.target_forwards += 1
+            if self.prefilled:
+                self.decode_seconds += seconds
+                self.decode_forwards += 1
+            else:
+                self.prefill_seconds += seconds
+                self.prefilled = True
+
+    def count_draft(self):
+        if self.active:
+            self.draft_forwards += 1
+
+    def speedup(self):
+        """Measured speedup and whether it comes from reference calls, or else the estimate."""
+        (assisted_seconds, assisted_tokens), (unassisted_seconds, unassisted_tokens) = (
+            self.reference["assisted"],
+            self.reference["unassisted"],
+        )
+        if assisted_tokens and unassisted_tokens:
+            return (unassisted_seconds / unassisted_tokens) / (assisted_seconds / assisted_tokens), True
+        decode_step_seconds = self.decode_seconds / self.decode_forwards if self.decode_forwards else 0.0
+        baseline_seconds = self.prefill_seconds + max(self.generated_tokens - self.calls, 0) * decode_step_seconds
+        return baseline_seconds / self.generate_seconds, False
+
+    def summary(self):
+        if not self.target_forwards:
+            return "Assisted decoding: no tokens generated"
+        accepted = max(self.generated_tokens - self.target_forwards, 0)
+        speedup, measured = self.speedup()
+        return (
+            f"Assisted decoding: {accepted} of {self.draft_forwards} draft tokens accepted "
+            f"({accepted / max(self.draft_forwards, 1):.1%}), "
+            f"{self.generated_tokens / self.target_forwards:.2f} tokens per target forward pass, "
+            + (
+                f"speedup {speedup:.2f}x measured on {self.reference_calls} calls also run without the draft"
+                if measured
+                else f"estimated speedup at most {speedup:.2f}x"
+            )
+        )
@@ -0,0 +1,85 @@
+BACKENDS = {}
+
+DEFAULT_MODEL_IDS = {
+    "hf": "llama-60B",
+    "openai": "gpt-3.5-turbo-instruct",
+    "fake": "fake",
+    "server": "llama-60B",
+}
+
+
+def register_backend(name):
+    def decorator(build):
+        BACKENDS[name] = build
+        return build
+
+    return decorator
+
+
+def build_llm(backend, **llm_params):
+    """Construct the LLM of a registered backend. Heavy imports happen here, not at module import."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[backend](**llm_params)
+
+
+@register_backend("hf")
+def build_huggingface_pipeline(model_id, temperature, max_new_tokens, callbacks=None):
+    from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
+
+    llm = HuggingFacePipeline.from_model_id(
+        model_id=model_id,
+        task="text-generation",
+        pipeline_kwargs={
+            "max_new_tokens": max_new_tokens,
+            "do_sample": True,
+            "temperature": temperature,
+            "return_full_text": False,
+        },
+        callbacks=callbacks,
+    )
+    # decoder-only models need left padding (and a pad token) to generate for a batch of prompts
+    llm.pipeline.tokenizer.padding_side = "left"
+    if llm.pipeline.tokenizer.pad_token is None:
+        llm.pipeline.tokenizer.pad_token = llm.pipeline.tokenizer.eos_token
+    return llm
+
+
+@register_backend("openai")
+def build_openai(model_id, temperature, max_new_tokens, callbacks=None, base_url=None, max_retries=2):
+    from langchain_openai import OpenAI
+
+    return OpenAI(
+        model=model_id,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        callbacks=callbacks,
+        base_url=base_url,
+        max_retries=max_retries,
+    )
+
+
+@register_backend("server")
+def build_server(
+    model_id, temperature, max_new_tokens, callbacks=None, base_url="http://localhost:8000/v1", max_retries=2
+):
+    # src.server speaks the OpenAI completions protocol; it rejects requests for another model
+    from langchain_openai import OpenAI
+
+    return OpenAI(
+        model=model_id,
+        temperature=temperature,
+        max_tokens=max_new_tokens,
+        callbacks=callbacks,
+        base_url=base_url,
+        api_key="unused",
+        max_retries=max_retries,
+    )
+
+
+@register_backend("fake")
+def build_fake(model_id, temperature, max_new_tokens, callbacks=None, latency_per_token=0.0):
+    # canned completions for benchmarks and dry pipeline runs; model_id and temperature are ignored
+    from src.fake_llm import FakeStanceLLM
+
+    return FakeStanceLLM(max_new_tokens=max_new_tokens, latency_per_token=latency_per_token, callbacks=callbacks)
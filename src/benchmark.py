@@ -0,0 +1,239 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from src.prompts import cot_stance_labels
+
+benchmark_targets = [
+    "Atheism",
+    "Climate Change is a Real Concern",
+    "Feminist Movement",
+    "Hillary Clinton",
+    "Legalization of Abortion",
+]
+benchmark_words = ["we", "should", "not", "vote", "for", "this", "today", "#SemST", "believe", "science",
+                   "rights", "people", "never", "always", "god", "women", "climate", "future", "@user", "!"]
+
+
+def synthetic_dataset(size, seed=0):
+    """Tweets of 8 to 40 random words with the features of the preprocessed datasets that inference reads."""
+    from datasets import ClassLabel, Dataset, Features, Value
+
+    rng = random.Random(seed)
+    return Dataset.from_dict(
+        {
+            "text": [" ".join(rng.choices(benchmark_words, k=rng.randint(8, 40))) for _ in range(size)],
+            "target": [rng.choice(benchmark_targets) for _ in range(size)],
+            "label": [rng.randrange(len(cot_stance_labels)) for _ in range(size)],
+        },
+        features=Features(
+            {"text": Value("string"), "target": Value("string"), "label": ClassLabel(names=cot_stance_labels)}
+        ),
+    )
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_config(config):
+    """Run one configuration through `inference.run` and measure it. Called in a fresh process per config."""
+    from src import inference
+    from src.backends import build_llm
+
+    args = inference.build_parser().parse_args([])
+    vars(args).update(
+        backend=config["backend"],
+        model_id=config["model_id"],
+        n=config["n"],
+        max_new_tokens=config["max_new_tokens"],
+        shard_size=0,
+        # the benchmark measures the pipeline, not the API budget
+        requests_per_minute=10 ** 9,
+        tokens_per_minute=10 ** 12,
+    )
+    if config["backend"] == "fake":
+        # the fake has no pipeline to batch: its batch size is the number of requests in flight
+        args.concurrency = config["batch_size"]
+        backend_kwargs = {"latency_per_token": config["latency_per_token"]}
+    else:
+        args.batch_size = config["batch_size"]
+        backend_kwargs = {}
+
+    # time spent turning completions into votes, measured on the functions the chains call
+    parse_seconds = [0.0]
+
+    def timed(fn):
+        def wrapper(*fn_args, **fn_kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*fn_args, **fn_kwargs)
+            finally:
+                parse_seconds[0] += time.perf_counter() - start
+
+        return wrapper
+
+    inference.parse_completion = timed(inference.parse_completion)
+    inference.aggregate_completions = timed(inference.aggregate_completions)
+
+    start = time.perf_counter()
+    llm = build_llm(
+        args.backend,
+        model_id=args.model_id,
+        temperature=args.temperature,
+        max_new_tokens=args.max_new_tokens,
+        **backend_kwargs,
+    )
+    load_seconds = time.perf_counter() - start
+
+    if config["backend"] == "fake":
+        count_calls = lambda: llm.num_calls
+    else:
+        from transformers import set_seed
+
+        set_seed(config["seed"])
+        # every generation, batched or not, is one call of the model's generate
+        model, generate, calls = llm.pipeline.model, llm.pipeline.model.generate, [0]
+
+        def counted_generate(*fn_args, **fn_kwargs):
+            calls[0] += 1
+            return generate(*fn_args, **fn_kwargs)
+
+        model.generate = counted_generate
+        count_calls = lambda: calls[0]
+
+    ds = synthetic_dataset(config["dataset_size"], seed=config["seed"])
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        inference.run(args, llm, ds, os.path.join(output_dir, "results"))
+        seconds = time.perf_counter() - start
+
+    return {
+        **config,
+        "load_seconds": round(load_seconds, 4),
+        "seconds": round(seconds, 4),
+        "examples_per_second": round(config["dataset_size"] / seconds, 3),
+        "llm_calls_per_example": round(count_calls() / config["dataset_size"], 3),
+        "parse_seconds": round(parse_seconds[0], 6),
+        "parse_fraction": round(parse_seconds[0] / seconds, 6),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tier_configs(tier, model_id, batch_sizes, ns, dataset_sizes, max_new_tokens, args):
+    for batch_size, n, dataset_size in itertools.product(batch_sizes, ns, dataset_sizes):
+        yield {
+            "tier": tier,
+            "backend": tier,
+            "model_id": model_id,
+            "batch_size": batch_size,
+            "n": n,
+            "dataset_size": dataset_size,
+            "max_new_tokens": max_new_tokens,
+            "latency_per_token": args.latency_per_token if tier == "fake" else None,
+            "seed": args.seed,
+        }
+
+
+def main(args):
+    configs = list(
+        tier_configs("fake", "fake", args.batch_sizes, args.n, args.dataset_sizes, args.max_new_tokens, args)
+    )
+    if args.hf_model_id:
+        configs += tier_configs(
+            "hf", args.hf_model_id, args.batch_sizes, args.n, args.hf_dataset_sizes, args.hf_max_new_tokens, args
+        )
+
+    results = []
+    for config in configs:
+        # a fresh process per configuration keeps the peak RSS of one run from leaking into the next
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            result = executor.submit(run_config, config).result()
+        results.append(result)
+        print(
+            f"{result['tier']:>4} batch_size={result['batch_size']:<3} n={result['n']:<2} "
+            f"size={result['dataset_size']:<5} {result['examples_per_second']:>9.2f} ex/s "
+            f"{result['llm_calls_per_example']:>6.2f} calls/ex "
+            f"parse {100 * result['parse_fraction']:.2f}% "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(args),
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the inference pipeline offline against a fake LLM and optionally a tiny HF model"
+    )
+    parser.add_argument(
+        "--batch_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 8],
+        help="Batch sizes (--batch_size for hf, --concurrency for the fake LLM)",
+    )
+    parser.add_argument("--n", type=int, nargs="+", default=[1, 3], help="Numbers of reasoning samples per tweet")
+    parser.add_argument(
+        "--dataset_sizes", type=int, nargs="+", default=[50, 200], help="Synthetic dataset sizes of the fake tier"
+    )
+    parser.add_argument(
+        "--latency_per_token",
+        type=float,
+        default=0.0002,
+        help="Seconds the fake LLM takes per generated token",
+    )
+    parser.add_argument(
+        "--max_new_tokens", type=int, default=150, help="Maximum number of generated tokens in the fake tier"
+    )
+    parser.add_argument(
+        "--hf_model_id",
+        type=str,
+        default=None,
+        help="Small causal LM run on CPU as a second tier (skipped when not given)",
+    )
+    parser.add_argument(
+        "--hf_dataset_sizes", type=int, nargs="+", default=[16], help="Synthetic dataset sizes of the hf tier"
+    )
+    parser.add_argument(
+        "--hf_max_new_tokens", type=int, default=32, help="Maximum number of generated tokens in the hf tier"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data and of sampling")
+    parser.add_argument(
+        "--output", type=str, default="results/benchmark.json", help="JSON file the results are written to"
+    )
+
+    args = parser.parse_args()
+    main(args)
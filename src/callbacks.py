@@ -1,7 +1,13 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import Any, Dict, List
+from uuid import UUID
 
 from langchain.callbacks import StdOutCallbackHandler
 from langchain.schema import LLMResult
+from langchain_core.callbacks import BaseCallbackHandler
 
 class RichStdOutCallbackHandler(StdOutCallbackHandler):
     def on_llm_start(
@@ -11,5 +17,173 @@ class RichStdOutCallbackHandler(StdOutCallbackHandler):
             print(f"Prompt:\n{prompt}")
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
-        for generation in response.generations:
-            print(f"Response:\n{generation.text}\n\n")
+        # one list of generations per prompt
+        for generations in response.generations:
+            for generation in generations:
+                print(f"Response:\n{generation.text}\n\n")
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """Records tokens, latency per stage and parse failures of every LLM call.
+
+    Queue time is the wait between a request being enqueued (the `enqueued_at` monotonic timestamp in the
+    run metadata, set by the rate limited runner) and the call starting. Prefill ends with the first
+    streamed token or, for a local model passed to `attach`, with its first forward pass; the rest of
+    the call is decode. Stages that can not be observed for a backend are left out of the percentiles.
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+    timings = ("queue_seconds", "prefill_seconds", "decode_seconds", "total_seconds")
+
+    def __init__(self, tokenizer=None, marker="stance: "):
+        self.tokenizer = tokenizer
+        self.marker = marker
+        self.calls = []
+        self.running = {}
+        self.lock = threading.Lock()
+        # throughput is measured from the first call to the last one that finished, not from construction,
+        # so loading the model and the dataset is not counted
+        self.started = None
+        self.finished = None
+
+    def count_tokens(self, text):
+        if self.tokenizer is not None:
+            return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+        # about four characters per token for English text
+        return len(text) // 4
+
+    def attach(self, model):
+        """Time the forward passes of a local torch model to split its calls into prefill and decode."""
+
+        def first_forward(module, inputs, output):
+            now = time.monotonic()
+            with self.lock:
+                for run in self.running.values():
+                    run.setdefault("first_token_at", now)
+
+        return model.register_forward_hook(first_forward)
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, metadata=None, **kwargs: Any
+    ) -> None:
+        now = time.monotonic()
+        enqueued_at = (metadata or {}).get("enqueued_at", now)
+        with self.lock:
+            if self.started is None:
+                self.started = now
+            self.running[run_id] = {
+                "started_at": now,
+                "queue_seconds": max(0.0, now - enqueued_at),
+                "prompt_tokens": sum(self.count_tokens(prompt) for prompt in prompts),
+            }
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if run_id in self.running:
+                self.running[run_id].setdefault("first_token_at", now)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        now = time.monotonic()
+        with self.lock:
+            run = self.running.pop(run_id, None)
+        if run is None:
+            return
+
+        texts = [generation.text for generations in response.generations for generation in generations]
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        call = {
+            "prompt_tokens": usage.get("prompt_tokens", run["prompt_tokens"]),
+            "completion_tokens": usage.get("completion_tokens", sum(self.count_tokens(t) for t in texts)),
+            "queue_seconds": run["queue_seconds"],
+            "prefill_seconds": None,
+            "decode_seconds": None,
+            "total_seconds": now - run["started_at"],
+            # same rule as inference.parse_completion: no stance after the marker
+            "parse_failures": sum(not text.partition(self.marker)[2].strip() for text in texts),
+        }
+        if "first_token_at" in run:
+            call["prefill_seconds"] = run["first_token_at"] - run["started_at"]
+            call["decode_seconds"] = now - run["first_token_at"]
+        with self.lock:
+            self.calls.append(call)
+            self.finished = now
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        with self.lock:
+            self.running.pop(run_id, None)
+
+    def summary(self):
+        import numpy as np
+
+        with self.lock:
+            calls = list(self.calls)
+            elapsed = self.finished - self.started if self.finished is not None else 0.0
+        completion_tokens = sum(call["completion_tokens"] for call in calls)
+        summary = {
+            "calls": len(calls),
+            "elapsed_seconds": elapsed,
+            "prompt_tokens": sum(call["prompt_tokens"] for call in calls),
+            "completion_tokens": completion_tokens,
+            "completion_tokens_per_second": completion_tokens / elapsed if elapsed else 0.0,
+            "parse_failures": sum(call["parse_failures"] for call in calls),
+        }
+        for name in ("prompt_tokens", "completion_tokens") + self.timings:
+            values = np.array([call[name] for call in calls if call[name] is not None], dtype=float)
+            stats = {"count": int(values.size), "sum": float(values.sum())}
+            if values.size:
+                percentiles = np.percentile(values, [100 * q for q in self.quantiles])
+                stats.update({f"p{int(100 * q)}": float(p) for q, p in zip(self.quantiles, percentiles)})
+            summary[name if name in self.timings else f"{name}_per_call"] = stats
+        return summary
+
+    def write_summary(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def prometheus(self, prefix="stance_llm"):
+        """The summary in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+        for name, help_text in [
+            ("calls", "LLM calls"),
+            ("prompt_tokens", "Prompt tokens"),
+            ("completion_tokens", "Completion tokens"),
+            ("parse_failures", "Completions without a stance"),
+        ]:
+            lines += [
+                f"# HELP {prefix}_{name}_total {help_text}",
+                f"# TYPE {prefix}_{name}_total counter",
+                f"{prefix}_{name}_total {summary[name]}",
+            ]
+        for name in self.timings:
+            stats = summary[name]
+            lines += [f"# HELP {prefix}_{name} Seconds per LLM call", f"# TYPE {prefix}_{name} summary"]
+            for q in self.quantiles:
+                if f"p{int(100 * q)}" in stats:
+                    lines.append(f'{prefix}_{name}{{quantile="{q}"}} {stats[f"p{int(100 * q)}"]}')
+            lines += [f"{prefix}_{name}_sum {stats['sum']}", f"{prefix}_{name}_count {stats['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve `prometheus()` at /metrics from a daemon thread; returns the server."""
+        handler = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = handler.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+
+class CompletionCache:
+    """Persistent LLM completion cache backed by SQLite with size-bounded LRU eviction.
+
+    Entries are addressed by the hash of (model id, decoding params, rendered prompt, sample index),
+    so the i-th self-consistency sample of a prompt is reused across runs.
+    """
+
+    def __init__(self, path, model_id, params, max_size_mb=1024):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                completion TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)"
+        )
+        self.connection.commit()
+        # the total size is kept up to date by triggers, so a put does not sum over the whole table;
+        # a cache written before the total existed is scanned once here
+        self.connection.executescript(
+            """BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (key, value)
+                SELECT 'total_size', COALESCE(SUM(size), 0) FROM completions;
+            CREATE TRIGGER IF NOT EXISTS completions_insert AFTER INSERT ON completions BEGIN
+                UPDATE meta SET value = value + new.size WHERE key = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS completions_update AFTER UPDATE OF size ON completions BEGIN
+                UPDATE meta SET value = value + new.size - old.size WHERE key = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS completions_delete AFTER DELETE ON completions BEGIN
+                UPDATE meta SET value = value - old.size WHERE key = 'total_size';
+            END;
+            COMMIT;"""
+        )
+
+        self.model_id = model_id
+        self.params = params
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, prompt, sample_index):
+        payload = json.dumps([self.model_id, self.params, prompt, sample_index], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, prompt, n, start=0):
+        """Return samples start..start+n-1 of a prompt, with None for every sample that is missing."""
+        keys = [self.make_key(prompt, i) for i in range(start, start + n)]
+        rows = self.connection.execute(
+            f"SELECT key, completion FROM completions WHERE key IN ({','.join('?' * n)})", keys
+        ).fetchall()
+        self.connection.executemany(
+            "UPDATE completions SET last_access = ? WHERE key = ?",
+            [(time.time(), key) for key, _ in rows],
+        )
+        self.connection.commit()
+
+        found = dict(rows)
+        completions = [found.get(key) for key in keys]
+        self.hits += len(found)
+        self.misses += n - len(found)
+        return completions
+
+    def put(self, prompt, completions):
+        """Store samples of a prompt given as {sample_index: completion}."""
+        now = time.time()
+        self.connection.executemany(
+            # an upsert instead of INSERT OR REPLACE: the implicit delete of a replace fires no trigger
+            "INSERT INTO completions (key, completion, size, last_access) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET completion = excluded.completion, size = excluded.size, "
+            "last_access = excluded.last_access",
+            [
+                (self.make_key(prompt, i), completion, len(completion.encode("utf-8")), now)
+                for i, completion in completions.items()
+            ],
+        )
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        (total,) = self.connection.execute("SELECT value FROM meta WHERE key = 'total_size'").fetchone()
+        if total <= self.max_size:
+            return
+
+        # drop the least recently used entries until the cache fits its size bound again
+        stale = []
+        for key, size in self.connection.execute(
+            "SELECT key, size FROM completions ORDER BY last_access"
+        ):
+            if total <= self.max_size:
+                break
+            stale.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM completions WHERE key = ?", stale)
+        self.connection.commit()
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"Completion cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate)"
@@ -0,0 +1,95 @@
+import threading
+
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+from src.logprob import common_prefix_length
+
+
+class StanceConstraint:
+    """Restricts the tokens after `stance:` to one of the allowed labels and stops once a label is complete.
+
+    The label token sequences are kept in a prefix trie. Rows of a generate call are tracked independently:
+    a row is unconstrained until it emits the marker, then only continuations of a label are allowed, and
+    it is finished as soon as a full label follows the marker.
+    """
+
+    def __init__(self, tokenizer, labels, marker="stance:"):
+        self.tokenizer = tokenizer
+        self.marker = marker
+        marker_ids = tokenizer(marker, add_special_tokens=False).input_ids
+        self.marker_window = len(marker_ids) + 2
+
+        self.children = {}
+        self.labels = set()
+        for label in labels:
+            ids = tokenizer(f"{marker} {label}", add_special_tokens=False).input_ids
+            ids = tuple(ids[common_prefix_length(ids, marker_ids):])
+            self.labels.add(ids)
+            for i in range(len(ids)):
+                self.children.setdefault(ids[:i], set()).add(ids[i])
+
+        self.logits_processor = StanceLogitsProcessor(self)
+        self.stopping_criteria = StanceStoppingCriteria(self)
+        # per thread and generate call: the prompt length and where each row's label starts
+        self.state = threading.local()
+
+    def attach(self, model):
+        """Start a fresh generation state whenever `model.generate` is called, in the calling thread.
+
+        The processor and stopping criteria are shared by every call (they are bound into the chain once),
+        so the prompt length is recorded from the generate call instead of guessed from the input length.
+        """
+        generate = model.generate
+
+        def constrained_generate(*args, **kwargs):
+            input_ids = kwargs["input_ids"] if "input_ids" in kwargs else args[0]
+            self.state.prompt_length = input_ids.shape[1]
+            self.state.label_start = {}
+            return generate(*args, **kwargs)
+
+        model.generate = constrained_generate
+
+    def label_prefix(self, row, ids):
+        """Label tokens generated so far by a row, or None while it has not emitted the marker."""
+        state = self.state
+        if not hasattr(state, "prompt_length"):
+            raise RuntimeError("StanceConstraint used by a generate call of a model it is not attached to")
+        if row not in state.label_start:
+            tail = ids[max(state.prompt_length, len(ids) - self.marker_window):]
+            if not self.tokenizer.decode(tail).endswith(self.marker):
+                return None
+            state.label_start[row] = len(ids)
+        return tuple(ids[state.label_start[row]:].tolist())
+
+
+class StanceLogitsProcessor(LogitsProcessor):
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores):
+        constraint = self.constraint
+        for row in range(input_ids.shape[0]):
+            prefix = constraint.label_prefix(row, input_ids[row])
+            allowed = constraint.children.get(prefix) if prefix is not None else None
+            if allowed:
+                mask = torch.full_like(scores[row], float("-inf"))
+                mask[list(allowed)] = 0
+                scores[row] = scores[row] + mask
+        return scores
+
+
+class StanceStoppingCriteria(StoppingCriteria):
+    def __init__(self, constraint):
+        self.constraint = constraint
+
+    def __call__(self, input_ids, scores, **kwargs):
+        constraint = self.constraint
+        return torch.tensor(
+            [
+                constraint.label_prefix(row, input_ids[row]) in constraint.labels
+                for row in range(input_ids.shape[0])
+            ],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
@@ -1,6 +1,9 @@
 import argparse
+import hashlib
+import json
 import os
-from datasets import load_dataset
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
 DATASETS_BUILDERS = {
     "semeval2016": "semeval_2016_task_6a.py",
@@ -8,18 +11,129 @@ DATASETS_BUILDERS = {
     "wtwt": "wt_wt.py",
 }
 
+STAMP_FILE = "preprocessing.json"
+
+# datasets whose builders hydrate tweets from the shared TweetStore in their TWEETER_CACHE directory
+TWEET_STORE_DATASETS = ("covid19", "wtwt")
+
+
+def builder_file(dataset_name):
+    return os.path.join("src", "stance_datasets", DATASETS_BUILDERS[dataset_name])
+
+
+def script_sha256(dataset_name):
+    with open(builder_file(dataset_name), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fingerprint(dataset_name, info):
+    """Builder version, builder script hash and source checksums that a dataset was built from."""
+    checksums = {
+        url: checksum["checksum"] for url, checksum in (info.download_checksums or {}).items()
+    }
+    return {
+        "version": str(info.version),
+        "script_sha256": script_sha256(dataset_name),
+        "source_checksums": checksums,
+    }
+
+
+def is_built_by_current_script(dataset_name, output_dir):
+    """Whether the saved dataset was built by the current builder script, which also fixes its version.
+
+    The source checksums in the stamp are only a record of what was downloaded: the sources are not fetched
+    again to compare them, so changed upstream files are not detected and need `--force`.
+    """
+    stamp_path = os.path.join(output_dir, STAMP_FILE)
+    if not os.path.exists(stamp_path):
+        return False
+    with open(stamp_path, "r") as f:
+        saved = json.load(f)
+    return saved.get("script_sha256") == script_sha256(dataset_name)
+
+
+def migrate_tweet_cache():
+    """Import a legacy per-file tweet cache into the shared store before any builder opens it."""
+    from src.stance_datasets.tweet_store import TweetStore
+
+    cache_dir = Path(os.environ.get("DATA_DIR", os.getcwd() + "/data")) / "twitter_cache"
+    if not cache_dir.is_dir():
+        return
+    count = TweetStore(cache_dir / "tweets.sqlite").migrate_from_dir(cache_dir)
+    if count:
+        print(f"Imported {count} cached tweets into {cache_dir / 'tweets.sqlite'}")
+
+
+def preprocess(dataset_name, num_proc=None, force=False):
+    from datasets import load_dataset
+
+    output_dir = os.path.join("data", "preprocessed", dataset_name)
+    if not force and is_built_by_current_script(dataset_name, output_dir):
+        return f"{dataset_name}: {output_dir} was built by the current builder script, skipping"
+
+    # all_checks records the checksums of the downloaded sources in the dataset info
+    ds = load_dataset(
+        path=builder_file(dataset_name),
+        trust_remote_code=True,
+        num_proc=num_proc,
+        verification_mode="all_checks",
+    )
+
+    ds.save_to_disk(output_dir)
+    with open(os.path.join(output_dir, STAMP_FILE), "w") as f:
+        json.dump(fingerprint(dataset_name, next(iter(ds.values())).info), f, indent=2)
+    return f"{dataset_name}: {ds}"
+
+
 def main(args):
+    dataset_names = list(DATASETS_BUILDERS) if "all" in args.dataset_name else args.dataset_name
+    dataset_names = list(dict.fromkeys(dataset_names))
+    if any(dataset_name in TWEET_STORE_DATASETS for dataset_name in dataset_names):
+        # once, here: the builders and their num_proc shards then find the store already migrated
+        migrate_tweet_cache()
 
-    file_path = os.path.join("src", "stance_datasets", DATASETS_BUILDERS[args.dataset_name])
-    ds = load_dataset(path=file_path, trust_remote_code=True)
+    if len(dataset_names) == 1 or args.max_workers == 1:
+        for dataset_name in dataset_names:
+            print(preprocess(dataset_name, num_proc=args.num_proc, force=args.force))
+        return
 
-    ds.save_to_disk("data/preprocessed/" + args.dataset_name)
-    print(ds)
+    # each builder runs in its own process; num_proc further shards a builder's generation
+    with ProcessPoolExecutor(max_workers=args.max_workers or len(dataset_names)) as executor:
+        futures = {
+            executor.submit(preprocess, dataset_name, args.num_proc, args.force): dataset_name
+            for dataset_name in dataset_names
+        }
+        for future in as_completed(futures):
+            print(future.result())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Preprocess data for stance detection")
-    parser.add_argument("--dataset_name", type=str, required=True, help="Name of the dataset")
+    parser.add_argument(
+        "--dataset_name",
+        type=str,
+        nargs="+",
+        required=True,
+        choices=list(DATASETS_BUILDERS) + ["all"],
+        help="Name of the dataset(s), or `all`",
+    )
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=None,
+        help="Number of processes each builder uses to generate its splits",
+    )
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=None,
+        help="Number of datasets built concurrently (defaults to one process per dataset)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild even if the saved dataset was built by the current builder script, e.g. after the sources changed",
+    )
 
     args = parser.parse_args()
     main(args)
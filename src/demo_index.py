@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+from src.prompts import cot_demos
+
+token_pattern = re.compile(r"[#@]?\w+")
+
+
+def tokenize(text):
+    return token_pattern.findall(text.lower())
+
+
+class DemoIndex:
+    """TF-IDF vectors of a pool of demonstrations with a vectorized top-k lookup.
+
+    A demonstration is a dict with `id`, `text`, `target`, `reasoning` and `stance`; it is matched on its
+    tweet and target. Vectors are L2 normalised, so a matrix product gives the cosine similarities.
+    """
+
+    def __init__(self, demos, vocabulary, idf, vectors):
+        self.demos = demos
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.vectors = vectors
+
+    @classmethod
+    def build(cls, demos):
+        documents = [tokenize(demo["text"] + " " + demo["target"]) for demo in demos]
+        vocabulary = {token: i for i, token in enumerate(sorted({t for doc in documents for t in doc}))}
+        counts = cls.count_matrix(documents, vocabulary)
+        df = (counts > 0).sum(axis=0)
+        idf = (np.log((1 + len(demos)) / (1 + df)) + 1).astype(np.float32)
+        return cls(demos, vocabulary, idf, cls.normalize(counts * idf))
+
+    @staticmethod
+    def count_matrix(documents, vocabulary):
+        counts = np.zeros((len(documents), len(vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(documents):
+            columns = [vocabulary[token] for token in doc if token in vocabulary]
+            np.add.at(counts[row], columns, 1)
+        return counts
+
+    @staticmethod
+    def normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "demos.json"), "w") as f:
+            json.dump({"demos": self.demos, "vocabulary": self.vocabulary}, f)
+        np.save(os.path.join(path, "idf.npy"), self.idf)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "demos.json"), "r") as f:
+            saved = json.load(f)
+        # the vectors are memory-mapped, large pools are not read into memory up front
+        return cls(
+            saved["demos"],
+            saved["vocabulary"],
+            np.load(os.path.join(path, "idf.npy")),
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+        )
+
+    def top_k(self, texts, targets, k):
+        """Indices of the k most similar demonstrations of every (text, target), most similar first."""
+        queries = self.count_matrix(
+            [tokenize(text + " " + target) for text, target in zip(texts, targets)], self.vocabulary
+        )
+        scores = self.normalize(queries * self.idf) @ np.asarray(self.vectors).T
+        k = min(k, len(self.demos))
+        # stable sort: ties keep the pool order, so the selection is reproducible
+        return np.argsort(-scores, axis=1, kind="stable")[:, :k]
+
+
+def main(args):
+    demos = cot_demos
+    if args.demos:
+        with open(args.demos, "r") as f:
+            demos = [json.loads(line) for line in f if line.strip()]
+    DemoIndex.build(demos).save(args.output_dir)
+    print(f"Indexed {len(demos)} demonstrations in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the few-shot demonstration index")
+    parser.add_argument(
+        "--demos",
+        type=str,
+        default=None,
+        help="JSON lines file of demonstrations with id, text, target, reasoning and stance "
+        "(defaults to the demonstrations of the fixed prompt)",
+    )
+    parser.add_argument(
+        "--output_dir", type=str, default="data/demo_index", help="Directory the index is written to"
+    )
+
+    args = parser.parse_args()
+    main(args)
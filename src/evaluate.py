@@ -0,0 +1,153 @@
+import argparse
+import json
+
+import numpy as np
+
+from src.predictions import join_inputs, load_inputs
+from src.prompts import label_aliases
+
+
+def scored_labels(names):
+    """Labels averaged into the F1 score: favor and against (SemEval convention) or else all labels."""
+    if "favor" in names and "against" in names:
+        return [names.index("against"), names.index("favor")]
+    return list(range(len(names)))
+
+
+def encode_predictions(preds, names):
+    """ClassLabel ids of the predicted stances; missing or unknown predictions are `len(names)`."""
+    aliases = label_aliases.get(tuple(names), {})
+    ids = {name: i for i, name in enumerate(names)}
+    ids.update({alias: ids[name] for alias, name in aliases.items()})
+    return np.array([ids.get((pred or "").strip().lower(), len(names)) for pred in preds], dtype=np.int64)
+
+
+def confusion_matrices(gold, pred, num_labels, groups=None, num_groups=1):
+    """Confusion matrices of shape (num_groups, num_labels, num_labels + 1); the last column counts invalid predictions."""
+    codes = gold * (num_labels + 1) + pred
+    if groups is not None:
+        codes = codes + groups * num_labels * (num_labels + 1)
+    counts = np.bincount(codes.ravel(), minlength=num_groups * num_labels * (num_labels + 1))
+    return counts.reshape(num_groups, num_labels, num_labels + 1)
+
+
+def f1_scores(confusion, labels):
+    """Average F1 over `labels` of every matrix in a stack of confusion matrices."""
+    tp = np.diagonal(confusion[..., :-1], axis1=-2, axis2=-1)
+    predicted = confusion[..., :-1].sum(axis=-2)
+    actual = confusion.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f1 = np.where(predicted + actual > 0, 2 * tp / (predicted + actual), 0.0)
+    return f1[..., labels].mean(axis=-1)
+
+
+def accuracies(confusion):
+    total = confusion.sum(axis=(-2, -1))
+    return np.diagonal(confusion[..., :-1], axis1=-2, axis2=-1).sum(axis=-1) / np.maximum(total, 1)
+
+
+def expected_calibration_error(confidence, correct, num_bins=10):
+    """Weighted gap between the mean confidence and the accuracy of equal-width confidence bins."""
+    bins = np.minimum((confidence * num_bins).astype(np.int64), num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    gaps = np.abs(
+        np.bincount(bins, weights=confidence, minlength=num_bins) - np.bincount(bins, weights=correct, minlength=num_bins)
+    )
+    return float(gaps.sum() / max(counts.sum(), 1))
+
+
+def bootstrap(gold, pred, num_labels, labels, num_resamples=1000, seed=0, max_cells=10_000_000):
+    """F1 and accuracy of `num_resamples` resamples of the examples, drawn in chunks of up to `max_cells` indices."""
+    rng = np.random.default_rng(seed)
+    n = len(gold)
+    chunk = max(1, max_cells // max(n, 1))
+    f1, accuracy = [], []
+    for start in range(0, num_resamples, chunk):
+        size = min(chunk, num_resamples - start)
+        indices = rng.integers(0, n, size=(size, n))
+        resamples = np.broadcast_to(np.arange(size)[:, None], indices.shape)
+        confusion = confusion_matrices(gold[indices], pred[indices], num_labels, groups=resamples, num_groups=size)
+        f1.append(f1_scores(confusion, labels))
+        accuracy.append(accuracies(confusion))
+    return np.concatenate(f1), np.concatenate(accuracy)
+
+
+def evaluate(path, num_resamples=1000, confidence_level=0.95, num_bins=10, seed=0):
+    from datasets import load_from_disk
+
+    # load_from_disk memory-maps the Arrow files; only the scored columns are read
+    ds = load_from_disk(path)
+    if "label" not in ds.column_names:
+        # predictions saved without --join_inputs: the labels and targets are looked up by row_index
+        ds = join_inputs(
+            ds.select_columns(["row_index", "pred", "confidence"]), load_inputs(path).select_columns(["label", "target"])
+        )
+    names = ds.features["label"].names
+    table = ds.select_columns(["label", "pred", "target", "confidence"]).with_format("arrow")[:]
+    gold = table.column("label").to_numpy().astype(np.int64)
+    pred = encode_predictions(table.column("pred").to_pylist(), names)
+    targets, groups = np.unique(np.array(table.column("target").to_pylist(), dtype=str), return_inverse=True)
+
+    num_labels, labels = len(names), scored_labels(names)
+    overall = confusion_matrices(gold, pred, num_labels)
+    per_target = confusion_matrices(gold, pred, num_labels, groups=groups, num_groups=len(targets))
+
+    correct = (gold == pred).astype(np.float64)
+    confidence = table.column("confidence").to_numpy(zero_copy_only=False).astype(np.float64)
+    has_confidence = ~np.isnan(confidence)
+
+    f1_samples, accuracy_samples = bootstrap(gold, pred, num_labels, labels, num_resamples, seed)
+    tail = 100 * (1 - confidence_level) / 2
+    return {
+        "path": path,
+        "num_examples": len(gold),
+        "invalid_predictions": int((pred == num_labels).sum()),
+        "labels": names,
+        "f1_labels": [names[i] for i in labels],
+        "f1": float(f1_scores(overall, labels)[0]),
+        "f1_ci": np.percentile(f1_samples, [tail, 100 - tail]).tolist(),
+        "accuracy": float(accuracies(overall)[0]),
+        "accuracy_ci": np.percentile(accuracy_samples, [tail, 100 - tail]).tolist(),
+        "ece": expected_calibration_error(confidence[has_confidence], correct[has_confidence], num_bins),
+        "per_target": {
+            target: {"num_examples": int(confusion.sum()), "f1": float(f1), "accuracy": float(accuracy)}
+            for target, confusion, f1, accuracy in zip(
+                targets, per_target, f1_scores(per_target, labels), accuracies(per_target)
+            )
+        },
+        "confusion_matrix": overall[0].tolist(),
+    }
+
+
+def main(args):
+    reports = []
+    for path in args.results:
+        report = evaluate(path, args.num_resamples, args.confidence_level, args.num_bins, args.seed)
+        reports.append(report)
+        low, high = report["f1_ci"]
+        print(
+            f"{path}: F1 {report['f1']:.4f} [{low:.4f}, {high:.4f}] "
+            f"accuracy {report['accuracy']:.4f} ECE {report['ece']:.4f} "
+            f"({report['num_examples']} examples, {report['invalid_predictions']} invalid predictions)"
+        )
+        for target, scores in report["per_target"].items():
+            print(f"  {target}: F1 {scores['f1']:.4f} accuracy {scores['accuracy']:.4f} ({scores['num_examples']})")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the predictions of inference runs")
+    parser.add_argument("results", type=str, nargs="+", help="Result directories written by src.inference")
+    parser.add_argument(
+        "--num_resamples", type=int, default=1000, help="Bootstrap resamples of the confidence intervals"
+    )
+    parser.add_argument("--confidence_level", type=float, default=0.95, help="Coverage of the confidence intervals")
+    parser.add_argument("--num_bins", type=int, default=10, help="Confidence bins of the calibration error")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the bootstrap resamples")
+    parser.add_argument("--output", type=str, default=None, help="JSON file the scores are written to")
+
+    args = parser.parse_args()
+    main(args)
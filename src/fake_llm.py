@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_community.llms.utils import enforce_stop_tokens
+from langchain_core.language_models.llms import LLM
+from langchain_core.pydantic_v1 import Field
+
+from src.prompts import cot_stance_labels
+
+
+class FakeStanceLLM(LLM):
+    """Deterministic stand-in for the model: canned `reasoning ... stance: X` completions with simulated latency.
+
+    Tokens are whitespace separated words. A completion takes `prefill_latency_per_token` per prompt token
+    plus `latency_per_token` per generated token. The i-th completion of a prompt is the same in every run.
+    """
+
+    labels: List[str] = cot_stance_labels
+    max_new_tokens: int = 150
+    reasoning_tokens: int = 40
+    latency_per_token: float = 0.0
+    prefill_latency_per_token: float = 0.0
+    seed: int = 0
+
+    num_calls: int = 0
+    num_prompt_tokens: int = 0
+    num_completion_tokens: int = 0
+    samples_drawn: Dict[str, int] = Field(default_factory=dict)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-stance"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"labels": self.labels, "reasoning_tokens": self.reasoning_tokens, "seed": self.seed}
+
+    def completion(self, prompt: str, stop: Optional[List[str]] = None):
+        """Return the next canned completion of `prompt` and the seconds the model would take to produce it."""
+        sample = self.samples_drawn.get(prompt, 0)
+        self.samples_drawn[prompt] = sample + 1
+        digest = hashlib.sha256(f"{self.seed}:{sample}:{prompt}".encode()).digest()
+        rng = random.Random(digest)
+
+        label = rng.choice(self.labels)
+        words = [rng.choice(["the", "author", "text", "target", "says", "about", "this", "claim"])
+                 for _ in range(self.reasoning_tokens)]
+        tokens = (" ".join(words) + f" -> the author is {label} the target.\nstance: {label}").split(" ")
+        # the model keeps going after the answer, like a real one that ignores the stop sequence
+        text = " ".join(tokens[: self.max_new_tokens]) + "\n\nText: "
+        if stop:
+            # the chain binds a single stop sequence as a string
+            text = enforce_stop_tokens(text, [stop] if isinstance(stop, str) else stop)
+
+        prompt_tokens, completion_tokens = len(prompt.split()), min(len(tokens), self.max_new_tokens)
+        self.num_calls += 1
+        self.num_prompt_tokens += prompt_tokens
+        self.num_completion_tokens += completion_tokens
+        delay = prompt_tokens * self.prefill_latency_per_token + completion_tokens * self.latency_per_token
+        return text, delay
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        text, delay = self.completion(prompt, stop)
+        time.sleep(delay)
+        return text
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        text, delay = self.completion(prompt, stop)
+        await asyncio.sleep(delay)
+        return text
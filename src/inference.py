@@ -1,69 +1,922 @@
 import argparse
-from datasets import load_from_disk
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_openai import OpenAI
-from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda
+import hashlib
+import json
+import os
+import shutil
+from array import array
 from collections import Counter
 
-
-from src.prompts import cot_prompt_template
+from src.backends import BACKENDS, DEFAULT_MODEL_IDS, build_llm
+from src.completion_cache import CompletionCache
+from src.predictions import inputs_path, join_inputs, record_inputs
+from src.prompts import (
+    cot_demos,
+    cot_prompt_template,
+    cot_retrieval_prompt_template,
+    cot_stance_labels,
+    label_aliases,
+    prompt_labels,
+    render_demos,
+)
 
 
-llm_params = {
-    "temperature": 0.7,
-    "max_tokens": 150,
-    # "callbacks": [RichStdOutCallbackHandler()],   # Uncomment this line to see the model's input and output
-}
-# llm = OpenAI(model="gpt-3.5-turbo-instruct", **llm_params)
+stop_sequence = "\n\n"
 
-llm = HuggingFacePipeline.from_model_id(
-    model_id="llama-60B",
-    task="text-generation",
-    pipeline_kwargs={"max_new_tokens": 150},
+# the arguments that change the results; a checkpointed run resumes with any other argument changed,
+# e.g. a lower --concurrency or another --batch_size after a crash
+result_args = (
+    "dataset_name",
+    "backend",
+    "model_id",
+    "temperature",
+    "max_new_tokens",
+    "mode",
+    "n",
+    "adaptive",
+    "max_n",
+    "confidence_threshold",
+    "constrained",
+    "num_demos",
+    "demo_index",
+    "num_shards",
+    "shard_index",
 )
 
 
+def parse_completion(res):
+    reasoning, _, stance = res.partition("stance: ")
+    return {"reasoning": reasoning, "stance": stance}
+
+
+def aggregate_completions(completions, num_columns=None):
+    n = len(completions)
+    reasonings = {f"reasoning_{i}": completions[i]["reasoning"].strip() for i in range(n)}
+    stances = {f"stance_{i}": completions[i]["stance"].strip() for i in range(n)}
+    pred = Counter(stances.values()).most_common(1)[0][0]
+    confindence = Counter(stances.values()).most_common(1)[0][1] / n
+
+    # rows that stopped sampling early still need every column of the dataset
+    for i in range(n, num_columns or n):
+        reasonings[f"reasoning_{i}"] = ""
+        stances[f"stance_{i}"] = ""
+
+    return {
+        **reasonings,
+        **stances,
+        "pred": pred,
+        "confidence": confindence
+    }
+
+
+def vote_decided(stances, n, max_n, confidence_threshold):
+    """Whether drawing more self-consistency samples can no longer change the outcome we accept."""
+    drawn = len(stances)
+    counts = [count for _, count in Counter(stances).most_common(2)]
+    leader, runner_up = counts[0], counts[1] if len(counts) > 1 else 0
+
+    if drawn < n:
+        # the leading stance can not be overtaken by the rest of the first n samples
+        return leader > runner_up + (n - drawn)
+    if drawn >= max_n or leader / drawn >= confidence_threshold:
+        return True
+    # ambiguous tweet: keep sampling up to max_n unless the leader is already safe
+    return leader > runner_up + (max_n - drawn)
+
+
+def constraint_kwargs(constraint):
+    if constraint is None:
+        return {}
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    return {
+        "logits_processor": LogitsProcessorList([constraint.logits_processor]),
+        "stopping_criteria": StoppingCriteriaList([constraint.stopping_criteria]),
+    }
+
+
+def sample_batch(llm, prompt_texts, n, llm_params, batch_size=1, prefix_cache=None, constraint=None):
+    from langchain_community.llms.utils import enforce_stop_tokens
+
+    # one generate call per batch: every prompt is tokenized once and its n samples share the call. generate
+    # repeats the prompt n times before the forward pass, so the prefill still runs n times (--prefix_cache
+    # prefills the shared few-shot prefix once)
+    if prefix_cache is not None:
+        generations = prefix_cache.generate(
+            prompt_texts,
+            num_return_sequences=n,
+            do_sample=True,
+            temperature=llm_params["temperature"],
+            max_new_tokens=llm_params["max_new_tokens"],
+            **constraint_kwargs(constraint),
+        )
+    else:
+        responses = llm.pipeline(
+            prompt_texts,
+            do_sample=True,
+            temperature=llm_params["temperature"],
+            num_return_sequences=n,
+            return_full_text=False,
+            batch_size=batch_size,
+            **constraint_kwargs(constraint),
+        )
+        generations = [[r["generated_text"] for r in samples] for samples in responses]
+
+    return [
+        [enforce_stop_tokens(text, [stop_sequence]) for text in samples]
+        for samples in generations
+    ]
+
+
+def sample_completions(llm, prompt_text, n, llm_params, prefix_cache=None, constraint=None):
+    return sample_batch(
+        llm, [prompt_text], n, llm_params, prefix_cache=prefix_cache, constraint=constraint
+    )[0]
+
+
+def schedule_batches(lengths, max_batch_tokens, n, max_new_tokens):
+    """Group example indices into length-sorted batches whose padded size fits the token budget."""
+    batches, batch = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # indices arrive in ascending length order, so the new example sets the padded length
+        padded_tokens = (lengths[i] + max_new_tokens) * (len(batch) + 1) * n
+        if batch and padded_tokens > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def batch_inputs(batch):
+    # one dict of column values per example of a batched map, e.g. the prompt variables
+    return [dict(zip(batch, values)) for values in zip(*batch.values())]
+
+
+def deduplicate(pairs):
+    """Rows to run, one per unique (text, target) pair, and each row's position among them (-1: empty text)."""
+    unique_rows, positions, row_map = [], {}, array("q")
+    for i, (text, target) in enumerate(pairs):
+        if not (text or "").strip():
+            row_map.append(-1)
+            continue
+        # a fixed-size digest instead of the strings keeps the lookup small on large splits
+        key = hashlib.blake2b(json.dumps([text, target]).encode(), digest_size=16).digest()
+        if key not in positions:
+            positions[key] = len(unique_rows)
+            unique_rows.append(i)
+        row_map.append(positions[key])
+    return unique_rows, row_map
+
+
+def iter_pairs(ds, batch_size=10_000):
+    """The (text, target) pairs of `ds`, read from the Arrow table one batch at a time."""
+    for batch in ds.select_columns(["text", "target"]).iter(batch_size=batch_size):
+        yield from zip(batch["text"], batch["target"])
+
+
+def fan_out(ds, results, row_map, cache_file_name, columns=("row_index",), batch_size=1000):
+    """The `columns` of every row of `ds` and the result columns of its unique row; skipped rows get nulls.
+
+    Written by a batched map to `cache_file_name`, so only one batch of the fanned-out rows is held in memory
+    at a time.
+    """
+    import numpy as np
+    import pyarrow as pa
+    from datasets import Features
+
+    outputs = results.select_columns(
+        [column for column in results.column_names if column not in ds.column_names]
+    ).with_format("arrow")
+    row_map = np.asarray(row_map)
+
+    def fan_out_batch(batch, indices):
+        positions = row_map[indices]
+        ran = positions >= 0
+        # the unique rows of the batch's examples; examples that were not run take a null index
+        rows = outputs[positions[ran].tolist()].take(pa.array(np.cumsum(ran) - 1, mask=~ran))
+        return pa.Table.from_arrays(
+            [batch.column(column) for column in columns] + rows.columns, names=list(columns) + rows.column_names
+        )
+
+    features = Features({**{column: ds.features[column] for column in columns}, **outputs.features})
+    return (
+        ds.select_columns(list(columns))
+        .with_format("arrow")
+        .map(
+            fan_out_batch,
+            batched=True,
+            batch_size=batch_size,
+            with_indices=True,
+            features=features,
+            cache_file_name=cache_file_name,
+        )
+        .with_format(None)
+    )
+
+
 def main(args):
-    ds = load_from_disk("data/preprocessed/" + args.dataset_name)["test"]
+    from datasets import load_from_disk
 
-    prompt = ChatPromptTemplate.from_template(cot_prompt_template)
-    cot_chain = (
-        prompt
-        | llm.bind(stop="\n\n")
-        | StrOutputParser()
-        | RunnableLambda(
-            lambda res: dict(zip(["reasoning", "stance"], res.split("stance: ")))
+    llm_params = {
+        "temperature": args.temperature,
+        "max_new_tokens": args.max_new_tokens,
+        # "callbacks": [RichStdOutCallbackHandler()],   # Uncomment this line to see the model's input and output
+    }
+    backend_kwargs = {}
+    if args.backend in ("openai", "server"):
+        # in concurrent mode 429s, 5xx and connection errors are retried by the rate limited runner, not by the client
+        backend_kwargs = {
+            "base_url": args.openai_base_url if args.backend == "openai" else args.server_url,
+            "max_retries": 0 if args.concurrency > 1 else 2,
+        }
+    metrics = None
+    if args.metrics_path or args.metrics_port:
+        from src.callbacks import MetricsCallbackHandler
+
+        metrics = MetricsCallbackHandler()
+        llm_params["callbacks"] = [metrics]
+    llm = build_llm(args.backend, model_id=args.model_id, **llm_params, **backend_kwargs)
+    if metrics is not None and hasattr(llm, "pipeline"):
+        # exact token counts and a prefill/decode split from the local model's forward passes
+        metrics.tokenizer = llm.pipeline.tokenizer
+        metrics.attach(llm.pipeline.model)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print(f"Serving metrics at http://localhost:{args.metrics_port}/metrics")
+
+    # only the test split is opened, memory-mapped; run() reads just the columns of the prompt from it
+    inputs = load_from_disk(inputs_path(args.dataset_name))
+    ds = inputs
+    output_path = os.path.join("results", args.dataset_name + "_cot")
+    if args.num_shards > 1:
+        import numpy as np
+
+        from src.sharding import shard_output_path, shard_rows
+
+        # every node computes the same split; row_index lets src.sharding restore the original order
+        rows = shard_rows(iter_pairs(ds), args.num_shards)[args.shard_index]
+        ds = ds.add_column("row_index", np.arange(len(ds))).select(rows)
+        output_path = shard_output_path(output_path, args.shard_index, args.num_shards)
+        print(f"Shard {args.shard_index} of {args.num_shards}: {len(ds)} rows")
+    run(args, llm, ds, output_path, inputs=inputs)
+    record_inputs(output_path, inputs_path(args.dataset_name))
+
+    if metrics is not None:
+        summary = metrics.summary()
+        print(
+            f"{summary['calls']} LLM calls, {summary['completion_tokens_per_second']:.1f} completion tokens/s, "
+            f"{summary['parse_failures']} parse failures"
         )
+        if args.metrics_path:
+            metrics.write_summary(args.metrics_path)
+
+
+def run(args, llm, ds, output_path, inputs=None):
+    """Run the inference mode configured by `args` over `ds` with an already built `llm`.
+
+    Only `text`, `target` and a `row_index` into `inputs` (by default `ds` itself) go through the
+    pipeline. The saved predictions hold the row_index and the outputs; with --join_inputs they are
+    joined back to the rows of `inputs`.
+    """
+    import numpy as np
+    from langchain_community.llms.utils import enforce_stop_tokens
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.runnables import RunnableLambda
+
+    label_names = ds.features["label"].names
+    if inputs is None:
+        inputs = ds
+    if "row_index" not in ds.column_names:
+        ds = ds.add_column("row_index", np.arange(len(ds)))
+    # ds.map writes every column of its input to the cache files together with the outputs
+    ds = ds.select_columns(["text", "target", "row_index"])
+    # the maps that stream to disk write their cache files here instead of next to the input split
+    scratch_dir = output_path + "_tmp"
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+
+    llm_params = {"temperature": args.temperature, "max_new_tokens": args.max_new_tokens}
+
+    constraint = None
+    if args.constrained:
+        from src.constrained import StanceConstraint
+
+        # generation ends right after a stance the prompt offers follows `stance:`; for a dataset with other
+        # label names these are the aliases src.evaluate maps back to its labels
+        constraint_labels = prompt_labels(label_names)
+        if constraint_labels != label_names:
+            aliases = label_aliases[tuple(label_names)]
+            print(
+                "Constraining to the prompt's stances "
+                + ", ".join(f"{label} (scored as {aliases[label]})" for label in constraint_labels)
+            )
+        constraint = StanceConstraint(llm.pipeline.tokenizer, constraint_labels)
+        constraint.attach(llm.pipeline.model)
+
+    bind_kwargs = {"stop": stop_sequence}
+    if constraint is not None:
+        bind_kwargs["pipeline_kwargs"] = constraint_kwargs(constraint)
+
+    assisted_stats = None
+    if args.draft_model_id:
+        from src.assisted import AssistedDecodingStats, load_draft_model
+
+        # the draft proposes tokens that the model verifies in one forward pass; sampling keeps the model's distribution
+        draft_model = load_draft_model(args.draft_model_id, llm.pipeline.model)
+        assisted_stats = AssistedDecodingStats(llm.pipeline.model, draft_model)
+        bind_kwargs["pipeline_kwargs"] = {"assistant_model": draft_model}
+
+    if args.num_demos:
+        from src.demo_index import DemoIndex
+
+        index = DemoIndex.load(args.demo_index) if args.demo_index else DemoIndex.build(cot_demos)
+
+        def select_demos(batch):
+            selected = index.top_k([text or "" for text in batch["text"]], batch["target"], args.num_demos)
+            return {
+                "demo_ids": [[index.demos[j]["id"] for j in row] for row in selected],
+                # the most similar demonstration goes right before the tweet
+                "demos": [render_demos([index.demos[j] for j in row[::-1]]) for row in selected],
+            }
+
+        ds = ds.map(
+            select_demos, batched=True, batch_size=256, cache_file_name=os.path.join(scratch_dir, "demos.arrow")
+        )
+        prompt = ChatPromptTemplate.from_template(cot_retrieval_prompt_template)
+    else:
+        prompt = ChatPromptTemplate.from_template(cot_prompt_template)
+    # the HF pipeline ignores `stop`, so the completion is also cut at the stop sequence here
+    llm_chain = (
+        llm.bind(**bind_kwargs)
+        | StrOutputParser()
+        | RunnableLambda(lambda res: enforce_stop_tokens(res, [stop_sequence]))
     )
+    completion_chain = prompt | llm_chain
+    cot_chain = completion_chain | RunnableLambda(parse_completion)
+
+    completion_cache = None
+    if args.cache_path:
+        completion_cache = CompletionCache(
+            args.cache_path,
+            model_id=args.model_id,
+            params={
+                "temperature": llm_params["temperature"],
+                "max_tokens": llm_params["max_new_tokens"],
+                "stop": stop_sequence,
+                **({"labels": prompt_labels(label_names)} if args.constrained else {}),
+            },
+            max_size_mb=args.cache_max_size_mb,
+        )
+
+    prefix_cache = None
+    if args.prefix_cache:
+        from src.prefix_cache import PrefixCache, split_prompt
+
+        # the few-shot demonstrations are identical for every tweet: prefill them once
+        prefix = split_prompt(lambda x: prompt.invoke(x).to_string())
+        prefix_cache = PrefixCache(llm.pipeline.model, llm.pipeline.tokenizer, prefix)
+
+    def generate_samples(prompt_texts, n, generate, start=0):
+        # look every prompt up in the completion cache and only generate the missing samples
+        if completion_cache is None:
+            return generate(prompt_texts, n)
+
+        cached = [completion_cache.get(prompt_text, n, start=start) for prompt_text in prompt_texts]
+        missing = [i for i, completions in enumerate(cached) if None in completions]
+        if missing:
+            k = max(cached[i].count(None) for i in missing)
+            generated = generate([prompt_texts[i] for i in missing], k)
+            for i, samples in zip(missing, generated):
+                samples = iter(samples)
+                fresh = {j: next(samples) for j, completion in enumerate(cached[i]) if completion is None}
+                completion_cache.put(prompt_texts[i], {start + j: completion for j, completion in fresh.items()})
+                cached[i] = [fresh.get(j, completion) for j, completion in enumerate(cached[i])]
+        return cached
 
     def self_consistency(x, n=3):
-        completions = [
-            cot_chain.invoke(dict(x)) for _ in range(n)
-        ]
+        if completion_cache is None:
+            completions = [
+                cot_chain.invoke(dict(x)) for _ in range(n)
+            ]
+        else:
+            [samples] = generate_samples(
+                [prompt.invoke(dict(x)).to_string()],
+                n,
+                lambda _, k: [[completion_chain.invoke(dict(x)) for _ in range(k)]],
+            )
+            completions = [parse_completion(res) for res in samples]
+        return {**x, **aggregate_completions(completions)}
 
-        reasonings = {f"reasoning_{i}": completions[i]["reasoning"].strip() for i in range(n)}
-        stances = {f"stance_{i}": completions[i]["stance"].strip() for i in range(n)}
-        pred = Counter(stances.values()).most_common(1)[0][0]
-        confindence = Counter(stances.values()).most_common(1)[0][1] / n
+    def batched_self_consistency(x, n=3):
+        [samples] = generate_samples(
+            [prompt.invoke(dict(x)).to_string()],
+            n,
+            lambda prompt_texts, k: [
+                sample_completions(
+                    llm, prompt_texts[0], k, llm_params, prefix_cache=prefix_cache, constraint=constraint
+                )
+            ],
+        )
+        completions = [parse_completion(res) for res in samples]
+        return {**x, **aggregate_completions(completions)}
+
+    def adaptive_self_consistency(x, n=3):
+        prompt_text = prompt.invoke(dict(x)).to_string()
+        if args.sampling == "batched":
+            generate = lambda prompt_texts, k: [
+                sample_completions(
+                    llm, prompt_texts[0], k, llm_params, prefix_cache=prefix_cache, constraint=constraint
+                )
+            ]
+        else:
+            generate = lambda _, k: [[completion_chain.invoke(dict(x)) for _ in range(k)]]
+
+        # the smallest possible majority of n is drawn at once, then one sample at a time
+        completions = []
+        k = n // 2 + 1
+        while True:
+            [samples] = generate_samples([prompt_text], k, generate, start=len(completions))
+            completions += [parse_completion(res) for res in samples]
+            stances = [completion["stance"].strip() for completion in completions]
+            if vote_decided(stances, n, args.max_n, args.confidence_threshold):
+                break
+            k = 1
 
         return {
             **x,
-            **reasonings,
-            **stances,
-            "pred": pred,
-            "confidence": confindence
+            **aggregate_completions(completions, num_columns=args.max_n),
+            "num_samples": len(completions),
         }
 
-    ds = ds.map(lambda x: self_consistency(x))
-    ds.save_to_disk("results" + args.dataset_name + "_cot")
+    def logprob_inference(batch):
+        from src.logprob import score_labels
 
-if __name__ == "__main__":
+        prompt_texts = [prompt.invoke(inputs).to_string() for inputs in batch_inputs(batch)]
+        # one greedy reasoning per tweet, then the candidate stances are scored instead of sampled
+        responses = llm.pipeline(
+            prompt_texts, do_sample=False, return_full_text=False, batch_size=len(prompt_texts)
+        )
+        reasonings = [
+            parse_completion(enforce_stop_tokens(r[0]["generated_text"], [stop_sequence]))["reasoning"].strip()
+            for r in responses
+        ]
+        probs = score_labels(
+            llm.pipeline.model,
+            llm.pipeline.tokenizer,
+            [prompt_text + reasoning + "\n" for prompt_text, reasoning in zip(prompt_texts, reasonings)],
+            cot_stance_labels,
+        )
+
+        return {
+            "reasoning_0": reasonings,
+            **{f"prob_{label}": [p[j] for p in probs] for j, label in enumerate(cot_stance_labels)},
+            "pred": [cot_stance_labels[p.index(max(p))] for p in probs],
+            "confidence": [max(p) for p in probs],
+        }
+
+    def batched_inference(batch, n=3):
+        prompt_texts = [prompt.invoke(inputs).to_string() for inputs in batch_inputs(batch)]
+        outputs = [None] * len(prompt_texts)
+        for indices in schedule_batches(
+            batch["prompt_length"], args.max_batch_tokens, n, llm_params["max_new_tokens"]
+        ):
+            samples = generate_samples(
+                [prompt_texts[i] for i in indices],
+                n,
+                lambda texts, k: sample_batch(
+                    llm,
+                    texts,
+                    k,
+                    llm_params,
+                    batch_size=len(texts),
+                    prefix_cache=prefix_cache,
+                    constraint=constraint,
+                ),
+            )
+            for i, completions in zip(indices, samples):
+                outputs[i] = aggregate_completions([parse_completion(res) for res in completions])
+
+        return {k: [output[k] for output in outputs] for k in outputs[0]}
+
+    def concurrent_inference(batch, n=3):
+        prompt_texts = [prompt.invoke(inputs).to_string() for inputs in batch_inputs(batch)]
+        samples = generate_samples(prompt_texts, n, runner.run)
+        outputs = [
+            aggregate_completions([parse_completion(res) for res in completions]) for completions in samples
+        ]
+        return {k: [output[k] for output in outputs] for k in outputs[0]}
+
+    runner = None
+    if args.num_workers > 1:
+        from src.worker_pool import WorkerPool
+
+        # replicas of the model in separate processes; each prompt's n samples come from one generate call
+        runner = WorkerPool(
+            args.model_id, llm_params, args.num_workers, num_threads=args.threads_per_worker, llm=llm
+        )
+    elif args.concurrency > 1:
+        from src.rate_limit import RateLimitedRunner
+
+        # the rendered prompt is what the LLM receives from the chat prompt template
+        runner = RateLimitedRunner(
+            llm_chain,
+            concurrency=args.concurrency,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            max_new_tokens=llm_params["max_new_tokens"],
+            max_retries=args.max_retries,
+        )
+
+    def run_inference(ds):
+        # the results of a shard go to its Parquet file, so the maps keep them in memory instead of writing
+        # another cache file next to the input split that nothing ever removes
+        if args.mode == "logprob":
+            return ds.map(logprob_inference, batched=True, batch_size=args.batch_size, keep_in_memory=True)
+        if runner is not None:
+            return ds.map(lambda x: concurrent_inference(x, n=args.n), batched=True, keep_in_memory=True)
+        if args.batch_size > 1:
+            # sort by prompt length so each batch pads to similar lengths, then restore the original order
+            ds = ds.map(
+                lambda x, idx: {
+                    "idx": idx,
+                    "prompt_length": len(llm.pipeline.tokenizer(prompt.invoke(dict(x)).to_string())["input_ids"]),
+                },
+                with_indices=True,
+                keep_in_memory=True,
+            )
+            ds = ds.sort("prompt_length", keep_in_memory=True)
+            ds = ds.map(
+                lambda x: batched_inference(x, n=args.n),
+                batched=True,
+                batch_size=args.batch_size,
+                keep_in_memory=True,
+            )
+            return ds.sort("idx", keep_in_memory=True).remove_columns(["idx", "prompt_length"])
+        if args.adaptive:
+            return ds.map(lambda x: adaptive_self_consistency(x, n=args.n), keep_in_memory=True)
+        if args.sampling == "batched" or args.prefix_cache:
+            return ds.map(lambda x: batched_self_consistency(x, n=args.n), keep_in_memory=True)
+        return ds.map(lambda x: self_consistency(x, n=args.n), keep_in_memory=True)
+
+    # retweets and repeated (text, target) pairs are run once; tweets that failed to hydrate not at all
+    unique_rows, row_map = deduplicate(iter_pairs(ds))
+    skipped = sum(j < 0 for j in row_map)
+    calls_per_example = 1 if args.mode == "logprob" else args.n
+    print(
+        f"Running {len(unique_rows)} unique (text, target) pairs of {len(ds)} rows "
+        f"({len(ds) - len(unique_rows) - skipped} duplicates, {skipped} empty texts): "
+        f"about {(len(ds) - len(unique_rows)) * calls_per_example} LLM calls saved"
+    )
+    unique_ds = ds.select(unique_rows)
+
+    writer = None
+    if args.shard_size > 0:
+        from src.result_writer import ShardedResultWriter
+
+        # results are checkpointed every shard_size examples; a restart skips the finished shards
+        writer = ShardedResultWriter(
+            output_path + "_shards",
+            num_rows=len(unique_ds),
+            shard_size=args.shard_size,
+            config={k: getattr(args, k) for k in result_args},
+        )
+        for index, start, end in writer.shard_ranges():
+            if writer.is_complete(index):
+                continue
+            writer.write(index, start, end, run_inference(unique_ds.select(range(start, end))))
+        results = writer.combine()
+    else:
+        results = run_inference(unique_ds)
+
+    # demo_ids are kept to reproduce the prompts; the rendered demonstrations are not
+    predictions = fan_out(
+        ds,
+        results,
+        row_map,
+        os.path.join(scratch_dir, "predictions.arrow"),
+        columns=["row_index", "demo_ids"] if args.num_demos else ["row_index"],
+    )
+    if args.join_inputs:
+        predictions = join_inputs(predictions, inputs)
+    predictions.save_to_disk(output_path)
+    shutil.rmtree(scratch_dir)
+    if writer is not None:
+        writer.cleanup()
+
+    if args.num_workers > 1:
+        runner.close()
+    elif runner is not None and runner.retries:
+        print(f"Retried {runner.retries} rate limited or failed requests")
+    if completion_cache is not None:
+        print(completion_cache.summary())
+    if assisted_stats is not None:
+        print(assisted_stats.summary())
+
+
+def validate_args(parser, args):
+    if args.model_id is None:
+        args.model_id = DEFAULT_MODEL_IDS[args.backend]
+
+    # these modes drive the transformers pipeline directly and are not available through an API
+    if args.backend != "hf":
+        for enabled, flag in [
+            (args.mode == "logprob", "--mode logprob"),
+            (args.constrained, "--constrained"),
+            (args.sampling == "batched", "--sampling batched"),
+            (args.prefix_cache, "--prefix_cache"),
+            (args.batch_size > 1, "--batch_size > 1"),
+        ]:
+            if enabled:
+                parser.error(f"{flag} requires --backend hf")
+
+    if args.draft_model_id:
+        for enabled, flag in [
+            (args.backend != "hf", "--backend other than hf"),
+            (args.mode == "logprob", "--mode logprob"),
+            (args.constrained, "--constrained"),
+            (args.sampling == "batched", "--sampling batched"),
+            (args.prefix_cache, "--prefix_cache"),
+            (args.batch_size > 1, "--batch_size > 1"),
+            (args.num_workers > 1, "--num_workers > 1"),
+        ]:
+            if enabled:
+                # assisted generation drafts for a single sequence per generate call
+                parser.error(f"--draft_model_id cannot be combined with {flag}")
+
+    if args.num_workers > 1:
+        for enabled, flag in [
+            (args.backend != "hf", "--backend other than hf"),
+            (args.mode == "logprob", "--mode logprob"),
+            (args.adaptive, "--adaptive"),
+            (args.constrained, "--constrained"),
+            (args.prefix_cache, "--prefix_cache"),
+            (args.batch_size > 1, "--batch_size > 1"),
+            (args.concurrency > 1, "--concurrency > 1"),
+        ]:
+            if enabled:
+                parser.error(f"--num_workers > 1 cannot be combined with {flag}")
+
+    if args.metrics_path or args.metrics_port:
+        for enabled, flag in [
+            (args.mode == "logprob", "--mode logprob"),
+            (args.sampling == "batched", "--sampling batched"),
+            (args.prefix_cache, "--prefix_cache"),
+            (args.batch_size > 1, "--batch_size > 1"),
+            (args.num_workers > 1, "--num_workers > 1"),
+        ]:
+            if enabled:
+                # these modes call the pipeline or the model directly, so the chain's callbacks never see a call
+                parser.error(f"--metrics_path and --metrics_port cannot be combined with {flag}")
+
+    if args.concurrency > 1 and (
+        args.sampling == "batched" or args.prefix_cache or args.batch_size > 1 or args.constrained
+    ):
+        parser.error(
+            "--concurrency > 1 cannot be combined with batched sampling, --prefix_cache, --batch_size or --constrained"
+        )
+
+    if args.mode == "logprob" and (args.adaptive or args.concurrency > 1 or args.cache_path):
+        parser.error(
+            "--mode logprob draws no samples and cannot be combined with --adaptive, --concurrency or --cache_path"
+        )
+
+    if args.adaptive:
+        if args.concurrency > 1 or args.batch_size > 1:
+            parser.error(
+                "--adaptive samples one tweet at a time and cannot be combined with --concurrency or --batch_size"
+            )
+        if args.max_n is None:
+            args.max_n = args.n
+        if args.max_n < args.n:
+            parser.error("--max_n must be at least --n")
+        if args.prefix_cache:
+            args.sampling = "batched"
+
+    if args.num_demos < 0:
+        parser.error("--num_demos must not be negative")
+    if args.num_demos and args.prefix_cache:
+        parser.error("--prefix_cache needs the demonstrations shared by all prompts and cannot be combined with --num_demos")
+
+    if args.num_shards < 1 or not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be in [0, --num_shards)")
+
+    dataset_path = os.path.join("data", "preprocessed", args.dataset_name)
+    if not os.path.isdir(dataset_path):
+        parser.error(f"Preprocessed dataset not found at {dataset_path}")
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description="Stance detection on tweets")
     parser.add_argument(
         "--dataset_name", type=str, help="Name of the dataset", default="semeval2016"
     )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=sorted(BACKENDS),
+        default="hf",
+        help="LLM backend; the model is only constructed once the run starts",
+    )
+    parser.add_argument(
+        "--model_id",
+        type=str,
+        default=None,
+        help="Model name or path (defaults: "
+        + ", ".join(f"{k}={v}" for k, v in DEFAULT_MODEL_IDS.items())
+        + ")",
+    )
+    parser.add_argument(
+        "--temperature", type=float, help="Sampling temperature", default=0.7
+    )
+    parser.add_argument(
+        "--max_new_tokens", type=int, help="Maximum number of generated tokens per completion", default=150
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Validate the configuration and print it without loading the model or the dataset",
+    )
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=["sample", "logprob"],
+        default="sample",
+        help="Vote over n sampled reasonings (sample) or score the stance labels after one greedy "
+        "reasoning from the model's log-probabilities (logprob)",
+    )
+    parser.add_argument(
+        "--n", type=int, help="Number of reasoning samples per tweet", default=3
+    )
+    parser.add_argument(
+        "--sampling",
+        type=str,
+        choices=["sequential", "batched"],
+        default="sequential",
+        help="Draw the self-consistency samples with n chain calls (sequential) "
+        "or with a single generate call returning n sequences (batched)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Stop sampling once the leading stance can not be overtaken within n samples; "
+        "ambiguous tweets are sampled further up to --max_n",
+    )
+    parser.add_argument(
+        "--max_n",
+        type=int,
+        default=None,
+        help="Sample budget of ambiguous tweets in adaptive mode (defaults to --n)",
+    )
+    parser.add_argument(
+        "--confidence_threshold",
+        type=float,
+        default=0.6,
+        help="In adaptive mode, a tweet is ambiguous after n samples while the leading stance has less "
+        "than this share of the votes",
+    )
+    parser.add_argument(
+        "--constrained",
+        action="store_true",
+        help="Restrict the tokens after `stance:` to the dataset's labels and stop generating right after one",
+    )
+    parser.add_argument(
+        "--prefix_cache",
+        action="store_true",
+        help="Prefill the shared few-shot prefix once and reuse its key/values for every generation "
+        "(implies batched sampling)",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help="SQLite file caching completions across runs; a rerun only generates the missing samples",
+    )
+    parser.add_argument(
+        "--cache_max_size_mb",
+        type=int,
+        default=1024,
+        help="Size bound of the completion cache; least recently used entries are evicted beyond it",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="Number of examples scheduled together; values above 1 enable cross-example batching",
+    )
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=16384,
+        help="Upper bound on padded tokens (prompt + new tokens, times n) in one generate call",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of LLM requests in flight; values above 1 run the chain concurrently with asyncio",
+    )
+    parser.add_argument(
+        "--draft_model_id",
+        type=str,
+        default=None,
+        help="Small model sharing the tokenizer of --model_id that drafts tokens for assisted generation "
+        "(hf backend, sequential sampling)",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of processes running a replica of the hf model on CPU; values above 1 spread the tweets "
+        "over them",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Torch threads of each worker (defaults to the number of cores divided by --num_workers)",
+    )
+    parser.add_argument(
+        "--requests_per_minute", type=int, help="Request budget of the concurrent mode", default=3500
+    )
+    parser.add_argument(
+        "--tokens_per_minute", type=int, help="Token budget of the concurrent mode", default=90000
+    )
+    parser.add_argument(
+        "--max_retries", type=int, help="Retries of a rate limited (HTTP 429), failed (5xx) or timed out request", default=6
+    )
+    parser.add_argument(
+        "--openai_base_url",
+        type=str,
+        default=None,
+        help="Base URL of an OpenAI compatible completions endpoint, e.g. a vLLM server",
+    )
+    parser.add_argument(
+        "--server_url",
+        type=str,
+        default="http://localhost:8000/v1",
+        help="Base URL of a running src.server for --backend server",
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=1000,
+        help="Write results to a Parquet shard every this many examples so an interrupted run can resume "
+        "(0 keeps all results in memory until the end)",
+    )
+    parser.add_argument(
+        "--join_inputs",
+        action="store_true",
+        help="Save the predictions joined to all columns of the input rows instead of only their row_index",
+    )
+    parser.add_argument(
+        "--num_demos",
+        type=int,
+        default=0,
+        help="Number of few-shot demonstrations most similar to each tweet put in its prompt "
+        "(0 uses all demonstrations of the fixed prompt)",
+    )
+    parser.add_argument(
+        "--demo_index",
+        type=str,
+        default=None,
+        help="Demonstration index built with src.demo_index (defaults to the demonstrations of the fixed prompt)",
+    )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="Split the test split across this many machines or processes; merge them with src.sharding",
+    )
+    parser.add_argument(
+        "--shard_index",
+        type=int,
+        default=0,
+        help="Which of the --num_shards length-balanced slices this run processes",
+    )
+    parser.add_argument(
+        "--metrics_path",
+        type=str,
+        default=None,
+        help="JSON file receiving token counts, per-stage latency percentiles and parse failures of the LLM "
+        "calls made through the chain",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Serve the same metrics in the Prometheus text format at http://localhost:PORT/metrics during the run",
+    )
+
+    return parser
 
+
+if __name__ == "__main__":
+    parser = build_parser()
     args = parser.parse_args()
-    main(args)
+    validate_args(parser, args)
+    if args.dry_run:
+        print(json.dumps(vars(args), indent=2))
+    else:
+        main(args)
@@ -0,0 +1,84 @@
+import torch
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def score_labels(model, tokenizer, contexts, labels, marker="stance:"):
+    """Probability distribution over `labels` following `marker` for each context.
+
+    The tokens every candidate shares (the prompt, the reasoning and the marker) are run once per context;
+    only the label tokens are then run, for all candidates at once, on top of the cached key/values. A
+    label's score is the sum of its token log-probabilities, normalized over the labels.
+    """
+    from transformers import DynamicCache
+
+    shared, suffixes, spans = [], [], []
+    for context in contexts:
+        marker_ids = tokenizer(context + marker).input_ids
+        sequences = [tokenizer(f"{context}{marker} {label}").input_ids for label in labels]
+        # the label starts where its tokenization diverges from the bare marker
+        starts = [common_prefix_length(ids, marker_ids) for ids in sequences]
+        length = min(starts)
+        shared.append(sequences[0][:length])
+        for ids, start in zip(sequences, starts):
+            suffixes.append(ids[length:])
+            spans.append((start - length, len(ids) - length))
+
+    # left-padded shared contexts: their last position is the one that predicts the first suffix token
+    context_len = max(len(ids) for ids in shared)
+    context_ids = torch.full((len(shared), context_len), tokenizer.pad_token_id, dtype=torch.long)
+    context_mask = torch.zeros_like(context_ids)
+    for row, ids in enumerate(shared):
+        context_ids[row, context_len - len(ids):] = torch.tensor(ids)
+        context_mask[row, context_len - len(ids):] = 1
+    context_ids, context_mask = context_ids.to(model.device), context_mask.to(model.device)
+
+    with torch.no_grad():
+        outputs = model(
+            input_ids=context_ids,
+            attention_mask=context_mask,
+            position_ids=(context_mask.cumsum(-1) - 1).clamp(min=0),
+            use_cache=True,
+        )
+    past_key_values = outputs.past_key_values
+    if isinstance(past_key_values, DynamicCache):
+        past_key_values = past_key_values.to_legacy_cache()
+    last_logits = outputs.logits[:, -1]
+
+    # every context's cache serves all of its candidates; the label suffixes are right-padded
+    num_labels = len(labels)
+    suffix_len = max(len(ids) for ids in suffixes)
+    suffix_ids = torch.full((len(suffixes), suffix_len), tokenizer.pad_token_id, dtype=torch.long)
+    suffix_mask = torch.zeros_like(suffix_ids)
+    for row, ids in enumerate(suffixes):
+        suffix_ids[row, : len(ids)] = torch.tensor(ids)
+        suffix_mask[row, : len(ids)] = 1
+    suffix_ids, suffix_mask = suffix_ids.to(model.device), suffix_mask.to(model.device)
+    context_mask = context_mask.repeat_interleave(num_labels, dim=0)
+    position_ids = context_mask.sum(-1, keepdim=True) + torch.arange(suffix_len, device=model.device)
+
+    with torch.no_grad():
+        logits = model(
+            input_ids=suffix_ids,
+            attention_mask=torch.cat([context_mask, suffix_mask], dim=-1),
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(
+                tuple(
+                    (key.repeat_interleave(num_labels, dim=0), value.repeat_interleave(num_labels, dim=0))
+                    for key, value in past_key_values
+                )
+            ),
+        ).logits
+
+    # suffix token k is predicted by the position before it: the context's last one for k = 0
+    logits = torch.cat([last_logits.repeat_interleave(num_labels, dim=0)[:, None], logits[:, :-1]], dim=1)
+    token_logprobs = torch.log_softmax(logits.float(), dim=-1).gather(-1, suffix_ids[:, :, None]).squeeze(-1)
+    scores = torch.stack([token_logprobs[row, start:end].sum() for row, (start, end) in enumerate(spans)])
+    return torch.softmax(scores.view(len(contexts), num_labels), dim=-1).tolist()
@@ -0,0 +1,31 @@
+import json
+import os
+
+# written next to the Arrow files of a predictions table: where the inputs its row_index points into are
+INPUTS_FILE = "inputs.json"
+
+
+def inputs_path(dataset_name):
+    return os.path.join("data", "preprocessed", dataset_name, "test")
+
+
+def record_inputs(output_path, inputs_path):
+    # relative to the predictions, so the results and the data can be moved together
+    with open(os.path.join(output_path, INPUTS_FILE), "w") as f:
+        json.dump({"inputs": os.path.relpath(inputs_path, output_path)}, f)
+
+
+def load_inputs(output_path):
+    """The memory-mapped input split a predictions table was made from."""
+    from datasets import load_from_disk
+
+    with open(os.path.join(output_path, INPUTS_FILE), "r") as f:
+        return load_from_disk(os.path.join(output_path, json.load(f)["inputs"]))
+
+
+def join_inputs(predictions, inputs):
+    """The rows of `inputs` that `predictions` were made for, followed by the prediction columns."""
+    from datasets import concatenate_datasets
+
+    inputs = inputs.remove_columns([column for column in predictions.column_names if column in inputs.column_names])
+    return concatenate_datasets([inputs.select(predictions["row_index"]), predictions], axis=1)
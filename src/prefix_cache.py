@@ -0,0 +1,92 @@
+import os
+
+import torch
+from transformers import DynamicCache
+
+
+def split_prompt(render):
+    """Split rendered prompts into the static prefix shared by every example and a per-example suffix.
+
+    `render` maps an example to its prompt text. The prefix is cut at the last blank line both
+    renderings share, so it ends on a demonstration boundary. Whether its tokens are also a prefix of
+    every full prompt's tokens depends on the tokenizer; PrefixCache checks this for every prompt.
+    """
+    a = render({"text": "a", "target": "a"})
+    b = render({"text": "b", "target": "b"})
+    common = os.path.commonprefix([a, b])
+    return common[: common.rfind("\n\n") + 2]
+
+
+class PrefixCache:
+    """Past key/values of a static prompt prefix, computed once and reused for every generation."""
+
+    def __init__(self, model, tokenizer, prefix):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(model.device)
+
+        with torch.no_grad():
+            past_key_values = model(self.prefix_ids, use_cache=True).past_key_values
+        if isinstance(past_key_values, DynamicCache):
+            past_key_values = past_key_values.to_legacy_cache()
+        self.past_key_values = past_key_values
+
+    def expand(self, batch_size):
+        # generate appends to the cache in place, so every call gets its own copy of the prefix
+        return DynamicCache.from_legacy_cache(
+            tuple(
+                (key.expand(batch_size, -1, -1, -1).clone(), value.expand(batch_size, -1, -1, -1).clone())
+                for key, value in self.past_key_values
+            )
+        )
+
+    def generate(self, prompt_texts, num_return_sequences=1, **generate_kwargs):
+        """Generate `num_return_sequences` continuations for each prompt; only the suffixes are prefilled.
+
+        Every prompt is tokenized in full and must start with the prefix's token ids; its suffix is the
+        rest of those ids. Tokenizing the suffix on its own can give other ids (SentencePiece marks the
+        start of a separately tokenized text), so the cached run would condition on a different prompt.
+        """
+        prefix_ids = self.prefix_ids[0].tolist()
+        prefix_len = len(prefix_ids)
+        suffix_ids = []
+        for prompt_text in prompt_texts:
+            assert prompt_text.startswith(self.prefix), "Prompt does not start with the cached prefix"
+            ids = self.tokenizer(prompt_text).input_ids
+            if ids[:prefix_len] != prefix_ids:
+                raise ValueError(
+                    "The tokens of the prompt do not start with the tokens of the cached prefix; "
+                    "this tokenizer tokenizes the prefix differently inside the prompt, run without --prefix_cache"
+                )
+            suffix_ids.append(ids[prefix_len:])
+
+        # pad between the prefix and the suffix so that the cached prefix stays aligned across rows;
+        # position ids are derived from the attention mask and skip the padding
+        max_len = max(len(ids) for ids in suffix_ids)
+        input_ids = torch.full(
+            (len(suffix_ids), prefix_len + max_len), self.tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :prefix_len] = self.prefix_ids[0]
+        attention_mask[:, :prefix_len] = 1
+        for row, ids in enumerate(suffix_ids):
+            input_ids[row, prefix_len + max_len - len(ids):] = torch.tensor(ids)
+            attention_mask[row, prefix_len + max_len - len(ids):] = 1
+
+        input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0).to(self.model.device)
+        attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0).to(self.model.device)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=self.expand(input_ids.shape[0]),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generate_kwargs,
+            )
+
+        texts = self.tokenizer.batch_decode(outputs[:, input_ids.shape[1]:], skip_special_tokens=True)
+        return [
+            texts[i : i + num_return_sequences] for i in range(0, len(texts), num_return_sequences)
+        ]
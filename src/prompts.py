@@ -1,40 +1,89 @@
-cot_prompt_template = """Q: What is the tweet's stance on the target?
+cot_prompt_header = """Q: What is the tweet's stance on the target?
 The options are:
 - against
 - favor
 - none
 
-tweet: <I'm sick of celebrities who think being a well known actor makes them an authority on anything else. #robertredford #UN>
-target: Liberal Values
-reasoning: the author is implying that celebrities should not be seen as authorities on political issues, which is often associated with liberal values such as Robert Redford who is a climate change activist -> the author is against liberal values
-stance: against
-
-tweet: <I believe in a world where people are free to move and choose where they want to live>
-target: Immigration
-reasoning: the author is expressing a belief in a world with more freedom of movement -> the author is in favor of immigration
-stance: favor
-
-tweet: <I love the way the sun sets every day. #Nature #Beauty>
-target: Taxes
-reasoning: the author is in favor of nature and beauty -> the author is neutral towards taxes
-stance: none
-
-tweet: <If a woman chooses to pursue a career instead of staying at home, is she any less of a mother?>
-target: Conservative Party
-reasoning: the author is questioning traditional gender roles, which are often supported by the conservative party -> the author is against the conservative party
-stance: against
-
-tweet: <We need to make sure that mentally unstable people can't become killers #protect #US>
-target: Gun Control
-reasoning: the author is advocating for measures to prevent mentally unstable people from accessing guns -> the author is in favor of gun control
-stance: favor
-
-tweet: <There is no shortcut to success, there's only hard work and dedication #Success #SuccessMantra>
-target: Open Borders
-reasoning: the author is in favor of hard work and dedication -> the author is neutral towards open borders
-stance: none
-
-tweet: <{text}>
+"""
+
+cot_demos = [
+    {
+        "id": "liberal-values",
+        "text": "I'm sick of celebrities who think being a well known actor makes them an authority on anything else. #robertredford #UN",
+        "target": "Liberal Values",
+        "reasoning": "the author is implying that celebrities should not be seen as authorities on political issues, which is often associated with liberal values such as Robert Redford who is a climate change activist -> the author is against liberal values",
+        "stance": "against",
+    },
+    {
+        "id": "immigration",
+        "text": "I believe in a world where people are free to move and choose where they want to live",
+        "target": "Immigration",
+        "reasoning": "the author is expressing a belief in a world with more freedom of movement -> the author is in favor of immigration",
+        "stance": "favor",
+    },
+    {
+        "id": "taxes",
+        "text": "I love the way the sun sets every day. #Nature #Beauty",
+        "target": "Taxes",
+        "reasoning": "the author is in favor of nature and beauty -> the author is neutral towards taxes",
+        "stance": "none",
+    },
+    {
+        "id": "conservative-party",
+        "text": "If a woman chooses to pursue a career instead of staying at home, is she any less of a mother?",
+        "target": "Conservative Party",
+        "reasoning": "the author is questioning traditional gender roles, which are often supported by the conservative party -> the author is against the conservative party",
+        "stance": "against",
+    },
+    {
+        "id": "gun-control",
+        "text": "We need to make sure that mentally unstable people can't become killers #protect #US",
+        "target": "Gun Control",
+        "reasoning": "the author is advocating for measures to prevent mentally unstable people from accessing guns -> the author is in favor of gun control",
+        "stance": "favor",
+    },
+    {
+        "id": "open-borders",
+        "text": "There is no shortcut to success, there's only hard work and dedication #Success #SuccessMantra",
+        "target": "Open Borders",
+        "reasoning": "the author is in favor of hard work and dedication -> the author is neutral towards open borders",
+        "stance": "none",
+    },
+]
+
+cot_demo_template = """tweet: <{text}>
+target: {target}
+reasoning: {reasoning}
+stance: {stance}
+
+"""
+
+cot_query_template = """tweet: <{text}>
 target: {target}
 reasoning:
 """
+
+
+def render_demos(demos):
+    # the result is a prompt variable, so braces in demonstrations need no escaping
+    return "".join(cot_demo_template.format_map(demo) for demo in demos)
+
+
+# all demonstrations, the same for every tweet
+cot_prompt_template = cot_prompt_header + render_demos(cot_demos) + cot_query_template
+
+# the demonstrations selected for a tweet are passed in the `demos` variable
+cot_retrieval_prompt_template = cot_prompt_header + "{demos}" + cot_query_template
+
+cot_stance_labels = ["against", "favor", "none"]
+
+# stances of the prompt that mean the same as a label of a dataset with its own label names
+label_aliases = {
+    ("refute", "support", "comment", "unrelated"): {"against": "refute", "favor": "support", "none": "comment"},
+}
+
+
+def prompt_labels(names):
+    """The stances the prompt offers for a dataset with ClassLabel `names`: its aliases of them, or the names."""
+    aliases = label_aliases.get(tuple(names))
+    return list(aliases) if aliases else list(names)
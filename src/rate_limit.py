@@ -0,0 +1,97 @@
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    """Continuously refilling budget of `rate_per_minute` units, e.g. requests or tokens."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # a single request may be larger than the bucket; it then waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            self.refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RateLimitedRunner:
+    """Runs many completions concurrently through a chain's `ainvoke`, within request and token budgets.
+
+    Requests rejected with HTTP 429, server errors (5xx), connection errors and timeouts are retried with
+    jittered exponential backoff; the client itself does not retry in this mode. Results are returned in
+    the order of the prompts.
+    """
+
+    def __init__(
+        self,
+        chain,
+        concurrency=16,
+        requests_per_minute=3500,
+        tokens_per_minute=90000,
+        max_new_tokens=150,
+        max_retries=6,
+        backoff_base=1.0,
+        backoff_max=60.0,
+    ):
+        self.chain = chain
+        self.concurrency = concurrency
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_new_tokens = max_new_tokens
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+
+    def estimate_tokens(self, prompt_text):
+        # about four characters per token for English text, plus the completion budget
+        return len(prompt_text) // 4 + self.max_new_tokens
+
+    async def complete(self, prompt_text, semaphore):
+        from openai import APIConnectionError, InternalServerError, RateLimitError
+
+        # the metrics callback reports the time from here to the start of the LLM call as queue time
+        config = {"metadata": {"enqueued_at": time.monotonic()}}
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.requests.acquire(1)
+                await self.tokens.acquire(self.estimate_tokens(prompt_text))
+                try:
+                    return await self.chain.ainvoke(prompt_text, config=config)
+                # APITimeoutError is an APIConnectionError
+                except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retries += 1
+                    response = getattr(e, "response", None)
+                    retry_after = response.headers.get("retry-after") if response is not None else None
+                    delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+                    if retry_after:
+                        delay = float(retry_after) + random.uniform(0, self.backoff_base)
+                    else:
+                        delay = random.uniform(0, delay)
+                    await asyncio.sleep(delay)
+
+    async def complete_all(self, prompt_texts, n):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        completions = await asyncio.gather(
+            *[self.complete(prompt_text, semaphore) for prompt_text in prompt_texts for _ in range(n)]
+        )
+        return [completions[i : i + n] for i in range(0, len(completions), n)]
+
+    def run(self, prompt_texts, n):
+        return asyncio.run(self.complete_all(prompt_texts, n))
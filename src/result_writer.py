@@ -0,0 +1,76 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+
+class ShardedResultWriter:
+    """Streams inference results to Parquet shards of `shard_size` rows, recorded in a manifest.
+
+    A shard is only listed in the manifest once its file is completely written, so a restarted run
+    skips exactly the shards that finished. `combine` assembles the shards into one Arrow dataset.
+    """
+
+    def __init__(self, output_dir, num_rows, shard_size, config=None):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_path = self.output_dir / "manifest.json"
+
+        settings = {"num_rows": num_rows, "shard_size": shard_size, "config": config or {}}
+        if self.manifest_path.exists():
+            with self.manifest_path.open("r") as f:
+                self.manifest = json.load(f)
+            previous = {k: self.manifest[k] for k in settings}
+            if previous != settings:
+                raise ValueError(
+                    f"Shards in {self.output_dir} were written with {previous}, not {settings}; "
+                    "remove the directory to start over"
+                )
+        else:
+            self.manifest = {**settings, "shards": {}}
+            self.save_manifest()
+
+    def shard_ranges(self):
+        num_rows, shard_size = self.manifest["num_rows"], self.manifest["shard_size"]
+        for index, start in enumerate(range(0, num_rows, shard_size)):
+            yield index, start, min(start + shard_size, num_rows)
+
+    def is_complete(self, index):
+        return str(index) in self.manifest["shards"]
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def write(self, index, start, end, dataset):
+        file_name = f"shard-{index:05d}.parquet"
+        tmp_path = self.output_dir / (file_name + ".tmp")
+        dataset.to_parquet(str(tmp_path))
+        os.replace(tmp_path, self.output_dir / file_name)
+
+        self.manifest["shards"][str(index)] = {
+            "file": file_name,
+            "start": start,
+            "end": end,
+            "num_rows": len(dataset),
+        }
+        self.save_manifest()
+
+    def combine(self):
+        """Load all shards, in order, as one memory-mapped dataset."""
+        from datasets import Dataset
+
+        missing = [index for index, _, _ in self.shard_ranges() if not self.is_complete(index)]
+        assert not missing, f"Shards {missing} have not been written"
+
+        files = [
+            str(self.output_dir / self.manifest["shards"][str(index)]["file"])
+            for index, _, _ in self.shard_ranges()
+        ]
+        # from_parquet converts the shards batch by batch into an on-disk Arrow cache
+        return Dataset.from_parquet(files, cache_dir=str(self.output_dir / "cache"))
+
+    def cleanup(self):
+        shutil.rmtree(self.output_dir)
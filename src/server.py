@@ -0,0 +1,362 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Sequence:
+    """One continuation being generated for a prompt of a request."""
+
+    def __init__(self, request, prompt_tokens):
+        self.request = request
+        self.prompt_tokens = prompt_tokens
+        self.generated = []
+        self.text = ""
+        self.finish_reason = None
+
+
+class CompletionRequest:
+    """A completions call: `n` continuations of each prompt, answered once all of them are finished."""
+
+    def __init__(self, prompts, n=1, max_tokens=16, temperature=1.0, stop=None):
+        self.prompts = prompts
+        self.n = n
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop = [stop] if isinstance(stop, str) else list(stop or [])
+        self.sequences = [[] for _ in prompts]
+        self.remaining = len(prompts) * n
+        self.error = None
+        self.done = threading.Event()
+
+
+class ContinuousBatchingScheduler:
+    """Generates for all running sequences one token at a time in a single batch.
+
+    Between decode steps, waiting prompts are prefilled and join the batch, and finished sequences
+    leave it, so the batch stays full while requests come and go. Rows of the key/value cache are
+    left-padded to a common length; the attention mask hides the padding and the position ids count
+    only real tokens.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size=32):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue()
+        self.waiting = deque()
+        self.running = []
+        self.admitted = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.steps = 0
+        self.completed = 0
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, request):
+        # prompts of a request are admitted one by one, each with its n continuations
+        for index in range(len(request.prompts)):
+            self.queue.put((request, index))
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def loop(self):
+        import torch
+
+        while True:
+            try:
+                with torch.inference_mode():
+                    self.admit(block=not self.running)
+                    self.step()
+            except Exception as e:
+                # a failed batch fails its requests, the server keeps serving new ones
+                failed = {sequence.request for sequence in self.running}
+                failed |= {request for request, _ in self.admitted}
+                for request in failed:
+                    request.error = e
+                    request.done.set()
+                self.running, self.admitted, self.past_key_values, self.attention_mask = [], [], None, None
+
+    def admit(self, block):
+        if block and not self.waiting:
+            self.waiting.append(self.queue.get())
+        while True:
+            try:
+                self.waiting.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        self.admitted, size = [], len(self.running)
+        while self.waiting and (size + self.waiting[0][0].n <= self.max_batch_size or not size):
+            request, index = self.waiting.popleft()
+            self.admitted.append((request, index))
+            size += request.n
+        if self.admitted:
+            self.prefill(self.admitted)
+        self.admitted = []
+
+    def prefill(self, admitted):
+        import torch
+
+        encoded = self.tokenizer(
+            [request.prompts[index] for request, index in admitted], return_tensors="pt", padding=True
+        ).to(self.model.device)
+        position_ids = (encoded.attention_mask.cumsum(-1) - 1).clamp(min=0)
+        outputs = self.model(
+            input_ids=encoded.input_ids,
+            attention_mask=encoded.attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+
+        # the prompt is prefilled once and its cache rows are repeated for the n continuations
+        repeats = torch.tensor([request.n for request, _ in admitted], device=self.model.device)
+        past_key_values = tuple(
+            (key.repeat_interleave(repeats, dim=0), value.repeat_interleave(repeats, dim=0))
+            for key, value in self.legacy(outputs.past_key_values)
+        )
+        attention_mask = encoded.attention_mask.repeat_interleave(repeats, dim=0)
+        logits = outputs.logits[:, -1].repeat_interleave(repeats, dim=0)
+
+        sequences = []
+        for (request, index), prompt_tokens in zip(admitted, encoded.attention_mask.sum(-1).tolist()):
+            for _ in range(request.n):
+                sequences.append(Sequence(request, prompt_tokens))
+                request.sequences[index].append(sequences[-1])
+
+        self.merge(sequences, past_key_values, attention_mask)
+        self.advance(sequences, logits)
+
+    def merge(self, sequences, past_key_values, attention_mask):
+        import torch
+
+        if not self.running:
+            self.running, self.past_key_values, self.attention_mask = sequences, past_key_values, attention_mask
+            return
+
+        # left-pad the shorter of the running and the new cache to the other's length
+        def pad(tensor, length, dim):
+            shape = list(tensor.shape)
+            shape[dim] = length - shape[dim]
+            return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+        length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+        self.past_key_values = tuple(
+            (
+                torch.cat([pad(key, length, 2), pad(new_key, length, 2)]),
+                torch.cat([pad(value, length, 2), pad(new_value, length, 2)]),
+            )
+            for (key, value), (new_key, new_value) in zip(self.past_key_values, past_key_values)
+        )
+        self.attention_mask = torch.cat([pad(self.attention_mask, length, 1), pad(attention_mask, length, 1)])
+        self.running = self.running + sequences
+
+    def step(self):
+        import torch
+        from transformers import DynamicCache
+
+        if not self.running:
+            return
+        input_ids = torch.tensor([[sequence.generated[-1]] for sequence in self.running], device=self.model.device)
+        # the new token's position is the number of real tokens before it
+        position_ids = self.attention_mask.sum(-1, keepdim=True)
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=1)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(self.past_key_values),
+            use_cache=True,
+        )
+        self.past_key_values = self.legacy(outputs.past_key_values)
+        self.steps += 1
+        self.advance(self.running, outputs.logits[:, -1])
+
+    def advance(self, sequences, logits):
+        """Sample the next token of `sequences` (the last rows of the batch) and retire finished ones."""
+        import torch
+
+        temperatures = torch.tensor([sequence.request.temperature for sequence in sequences], device=logits.device)
+        greedy = logits.argmax(-1)
+        probs = torch.softmax(logits.float() / temperatures.clamp(min=1e-5)[:, None], dim=-1)
+        sampled = torch.where(temperatures > 0, torch.multinomial(probs, 1).squeeze(-1), greedy)
+
+        for sequence, token in zip(sequences, sampled.tolist()):
+            sequence.generated.append(token)
+            self.check_finished(sequence)
+
+        keep = [row for row, sequence in enumerate(self.running) if sequence.finish_reason is None]
+        if len(keep) == len(self.running):
+            return
+        for sequence in self.running:
+            if sequence.finish_reason is not None:
+                self.finish(sequence)
+        self.running = [self.running[row] for row in keep]
+        if not self.running:
+            self.past_key_values, self.attention_mask = None, None
+            return
+
+        rows = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[rows]
+        # drop the columns that are padding in every remaining row
+        start = int((attention_mask.cumsum(-1) == 0).sum(-1).min())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (key[rows, :, start:], value[rows, :, start:]) for key, value in self.past_key_values
+        )
+
+    def check_finished(self, sequence):
+        request = sequence.request
+        if sequence.generated[-1] == self.tokenizer.eos_token_id:
+            sequence.finish_reason = "stop"
+        elif len(sequence.generated) >= request.max_tokens:
+            sequence.finish_reason = "length"
+        sequence.text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        for stop in request.stop:
+            if stop in sequence.text:
+                sequence.text = sequence.text[: sequence.text.index(stop)]
+                sequence.finish_reason = "stop"
+
+    def finish(self, sequence):
+        request = sequence.request
+        request.remaining -= 1
+        if request.remaining == 0:
+            self.completed += 1
+            request.done.set()
+
+    @staticmethod
+    def legacy(past_key_values):
+        return past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+
+
+class CompletionServer(ThreadingHTTPServer):
+    """OpenAI compatible `/v1/completions` endpoint in front of a continuous batching scheduler."""
+
+    daemon_threads = True
+
+    def __init__(self, address, model_id, scheduler):
+        super().__init__(address, CompletionRequestHandler)
+        self.model_id = model_id
+        self.scheduler = scheduler
+
+
+class CompletionRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": {"message": message, "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        scheduler = self.server.scheduler
+        if self.path.rstrip("/") == "/v1/models":
+            self.send_json(200, {"object": "list", "data": [{"id": self.server.model_id, "object": "model"}]})
+        elif self.path.rstrip("/") == "/health":
+            self.send_json(
+                200,
+                {
+                    "model": self.server.model_id,
+                    "running": len(scheduler.running),
+                    "waiting": len(scheduler.waiting) + scheduler.queue.qsize(),
+                    "steps": scheduler.steps,
+                    "completed": scheduler.completed,
+                },
+            )
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/completions":
+            self.send_error_json(404, f"Unknown path {self.path}")
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        # cached completions are keyed by model id, so a client must not get another model's output
+        if body.get("model") != self.server.model_id:
+            self.send_error_json(404, f"This server serves {self.server.model_id!r}, not {body.get('model')!r}")
+            return
+
+        prompts = body.get("prompt", "")
+        request = CompletionRequest(
+            [prompts] if isinstance(prompts, str) else prompts,
+            n=body.get("n") or 1,
+            max_tokens=body.get("max_tokens") or 16,
+            temperature=1.0 if body.get("temperature") is None else body["temperature"],
+            stop=body.get("stop"),
+        )
+        try:
+            self.server.scheduler.submit(request)
+        except Exception as e:
+            self.send_error_json(500, f"Generation failed: {e}")
+            return
+
+        sequences = [sequence for prompt_sequences in request.sequences for sequence in prompt_sequences]
+        self.send_json(
+            200,
+            {
+                "id": f"cmpl-{id(request)}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": self.server.model_id,
+                "choices": [
+                    {"text": sequence.text, "index": i, "logprobs": None, "finish_reason": sequence.finish_reason}
+                    for i, sequence in enumerate(sequences)
+                ],
+                "usage": {
+                    "prompt_tokens": sum(sequence.prompt_tokens for sequence in sequences),
+                    "completion_tokens": sum(len(sequence.generated) for sequence in sequences),
+                    "total_tokens": sum(sequence.prompt_tokens + len(sequence.generated) for sequence in sequences),
+                },
+            },
+        )
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(args):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model_id, torch_dtype="auto")
+    model.to("cuda" if torch.cuda.is_available() else "cpu").eval()
+
+    scheduler = ContinuousBatchingScheduler(model, tokenizer, max_batch_size=args.max_batch_size).start()
+    server = CompletionServer((args.host, args.port), args.model_id, scheduler)
+    print(f"Serving {args.model_id} at http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep a model loaded and serve OpenAI compatible completions with continuous batching"
+    )
+    parser.add_argument("--model_id", type=str, default="llama-60B", help="Model name or path")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=32,
+        help="Maximum number of sequences generated together; further prompts wait for a free slot",
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+import argparse
+import heapq
+import os
+from array import array
+
+from src.inference import deduplicate
+from src.predictions import inputs_path, record_inputs
+from src.prompts import cot_prompt_template
+
+
+def shard_rows(pairs, num_shards):
+    """Split the rows, given as (text, target) pairs, into `num_shards` lists of row indices of about equal LLM work.
+
+    Duplicated (text, target) pairs stay in one shard so they are still run once. The split only depends
+    on the data, so every node computes the same one.
+    """
+    lengths = array("q")
+
+    def measured(pairs):
+        for text, target in pairs:
+            lengths.append(len(text or "") + len(target or ""))
+            yield text, target
+
+    unique_rows, row_map = deduplicate(measured(pairs))
+    # a call's cost grows with its prompt, which is the shared few-shot template plus the tweet
+    costs = [len(cot_prompt_template) + lengths[i] for i in unique_rows]
+
+    # longest processing time first: each pair goes to the shard with the least work so far
+    loads = [(0, shard) for shard in range(num_shards)]
+    pair_shards = [0] * len(unique_rows)
+    for j in sorted(range(len(unique_rows)), key=lambda j: (-costs[j], j)):
+        load, shard = heapq.heappop(loads)
+        pair_shards[j] = shard
+        heapq.heappush(loads, (load + costs[j], shard))
+
+    shards = [[] for _ in range(num_shards)]
+    for i, j in enumerate(row_map):
+        # empty texts are not run; they are spread evenly so the merge still sees every row
+        shards[pair_shards[j] if j >= 0 else i % num_shards].append(i)
+    return shards
+
+
+def shard_output_path(output_path, shard_index, num_shards):
+    return f"{output_path}_part{shard_index}of{num_shards}"
+
+
+def merge_shards(output_path, num_shards, num_rows):
+    """Concatenate the shard outputs in the original row order after checking that they cover every row once."""
+    import numpy as np
+    from datasets import concatenate_datasets, load_from_disk
+
+    paths = [shard_output_path(output_path, i, num_shards) for i in range(num_shards)]
+    missing = [path for path in paths if not os.path.isdir(path)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard outputs: {', '.join(missing)}")
+
+    ds = concatenate_datasets([load_from_disk(path) for path in paths])
+    row_index = np.asarray(ds["row_index"])
+    counts = np.bincount(row_index, minlength=num_rows)
+    if len(counts) > num_rows or (counts != 1).any():
+        absent, repeated = np.flatnonzero(counts[:num_rows] == 0), np.flatnonzero(counts[:num_rows] > 1)
+        raise ValueError(
+            f"Shards do not cover the {num_rows} rows exactly once: {len(absent)} missing "
+            f"(e.g. {absent[:5].tolist()}), {len(repeated)} repeated (e.g. {repeated[:5].tolist()}), "
+            f"{int((counts[num_rows:] > 0).sum())} out of range"
+        )
+    # ds.sort would leave its indices mapping as a cache file in the first shard's directory
+    return ds.select(np.argsort(row_index, kind="stable"))
+
+
+def main(args):
+    from datasets import load_from_disk
+
+    num_rows = len(load_from_disk(inputs_path(args.dataset_name)))
+    output_path = os.path.join("results", args.dataset_name + "_cot")
+    merge_shards(output_path, args.num_shards, num_rows).save_to_disk(output_path)
+    record_inputs(output_path, inputs_path(args.dataset_name))
+    print(f"Merged {args.num_shards} shards of {num_rows} rows into {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of an inference run split with --num_shards/--shard_index"
+    )
+    parser.add_argument(
+        "--dataset_name", type=str, help="Name of the dataset", default="semeval2016"
+    )
+    parser.add_argument("--num_shards", type=int, required=True, help="Number of shards the run was split into")
+
+    args = parser.parse_args()
+    main(args)
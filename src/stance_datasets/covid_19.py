@@ -1,12 +1,13 @@
 import os
-import time
 from pathlib import Path
 
 import datasets
 import pandas as pd
-from tqdm.auto import tqdm
+import pyarrow as pa
 
-tqdm.pandas()
+from .labels import encode_labels
+from .tweet_store import TweetStore
+from .twitter import TweetHydrator
 
 _CITATION = """\
 @inproceedings{glandt-etal-2021-stance,
@@ -62,7 +63,7 @@ _URLS = {
 }
 
 
-class Covid19Stance(datasets.GeneratorBasedBuilder):
+class Covid19Stance(datasets.ArrowBasedBuilder):
     """Stance detection on tweets."""
 
     VERSION = datasets.Version("1.0.0")
@@ -135,42 +136,7 @@ class Covid19Stance(datasets.GeneratorBasedBuilder):
             ),
         ]
 
-    def get_tweet_by_id(self, tweet_id):
-        try:
-            CACHE_FILE = self.TWEETER_CACHE / f"{tweet_id}.text"
-            # check if tweet is cached
-            if CACHE_FILE.exists():
-                with CACHE_FILE.open("r") as f:
-                    text = f.read()
-            else:
-                # check if tweeter client is initialized
-                if self.twitter_client is None:
-                    import tweepy as tw
-                    import tweepy.errors as tw_errors
-
-                    barier_token = os.environ.get("TWITTER_API_BEARER_TOKEN")
-                    assert barier_token is not None, "TWITTER_API_BEARER_TOKEN is not set"
-
-                    self.twitter_client = tw.Client(bearer_token=self.barier_token)
-
-                tweet = self.twitter_client.get_tweet(tweet_id)
-                text = tweet.data.text if tweet.data else ""
-                time.sleep(3)
-
-                # cache tweet
-                CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-                with CACHE_FILE.open("w") as f:
-                    f.write(text)
-
-            return text
-        except tw_errors.TweepyException as e:
-            if e.response.status_code == 429:
-                # Rate limit reached, wait for 15 minutes before trying again
-                print(f"Rate limit reached. Sleeping for {60} seconds.")
-                time.sleep(60)
-                return self.get_tweet_by_id(tweet_id)
-
-    def _generate_examples(self, filepath, split):
+    def _generate_tables(self, filepath, split):
         # read a list of csv files
         _reader = pd.concat(
             [
@@ -185,10 +151,15 @@ class Covid19Stance(datasets.GeneratorBasedBuilder):
         )
 
         # get tweet text
-        _reader["text"] = _reader["tweet_id"].progress_apply(self.get_tweet_by_id)
+        _reader["tweet_id"] = _reader["tweet_id"].astype(str)
+        store = TweetStore(self.TWEETER_CACHE / "tweets.sqlite")
+        store.migrate_from_dir(self.TWEETER_CACHE)
+        texts = TweetHydrator(store, client=self.twitter_client).hydrate(_reader["tweet_id"])
+        _reader["text"] = _reader["tweet_id"].map(texts)
 
-        # convert label to int
-        _reader["label"] = _reader["label"].str.lower().apply(self.stance_labels.str2int)
+        # convert labels to int
+        _reader["label"] = encode_labels(_reader["label"].str.lower(), self.stance_labels)
+        _reader["sentiment"] = encode_labels(_reader["sentiment"].str.lower(), self.sentiment_labels)
 
         # convert target to title case
         _reader["target"] = _reader["target"].replace(self.target_map)
@@ -196,5 +167,6 @@ class Covid19Stance(datasets.GeneratorBasedBuilder):
         # add target
         _reader["split"] = split
 
-        for id, row in _reader.iterrows():
-            yield id, row.to_dict()
+        table = pa.Table.from_pandas(_reader[list(self.info.features)], preserve_index=False)
+        for id, batch in enumerate(table.to_batches(max_chunksize=10000)):
+            yield id, pa.Table.from_batches([batch])
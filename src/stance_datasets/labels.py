@@ -0,0 +1,7 @@
+def encode_labels(values, class_label):
+    """ClassLabel ids of a Series of label strings; like `str2int`, a string that is not a label raises."""
+    ids = values.map(dict(zip(class_label.names, range(class_label.num_classes))))
+    unknown = values[ids.isna()]
+    if len(unknown):
+        raise ValueError(f"Invalid string class label {unknown.iloc[0]} ({len(unknown)} rows)")
+    return ids.astype("int64")
@@ -0,0 +1,81 @@
+import sqlite3
+from pathlib import Path
+
+
+class TweetStore:
+    """Tweet texts of all datasets in a single indexed SQLite file."""
+
+    def __init__(self, path, timeout=600):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # builders in other processes share the file; a writer waits up to `timeout` seconds for their locks
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tweets (tweet_id TEXT PRIMARY KEY, text TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.commit()
+
+    def get_many(self, tweet_ids):
+        """Look up a whole column of ids in one query; ids that are not stored are left out."""
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup (tweet_id TEXT PRIMARY KEY)")
+        # the lookup runs in its own transaction, ended before returning: a read transaction left open keeps
+        # a shared lock on the store, which blocks writers in other processes and deadlocks two hydrators
+        # that both upgrade to a write lock in put_many
+        self.connection.execute("BEGIN")
+        try:
+            self.connection.execute("DELETE FROM lookup")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO lookup (tweet_id) VALUES (?)", ((str(i),) for i in tweet_ids)
+            )
+            rows = self.connection.execute(
+                "SELECT tweets.tweet_id, tweets.text FROM lookup JOIN tweets USING (tweet_id)"
+            ).fetchall()
+            self.connection.execute("DELETE FROM lookup")
+        finally:
+            self.connection.rollback()
+        return dict(rows)
+
+    def put_many(self, texts):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO tweets (tweet_id, text) VALUES (?, ?)", texts.items()
+        )
+        self.connection.commit()
+
+    def migrate_from_dir(self, cache_dir, batch_size=10000):
+        """One-time import of a legacy `{tweet_id}.text` per-file cache; returns the number of tweets read."""
+        cache_dir = Path(cache_dir)
+        key = f"migrated:{cache_dir.resolve()}"
+        if self.migrated(key):
+            return 0
+
+        # the write lock is held for the whole import: a process migrating the same directory at the same
+        # time waits here and then finds the marker instead of importing it a second time
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.migrated(key):
+                self.connection.rollback()
+                return 0
+
+            count, batch = 0, {}
+            for cache_file in cache_dir.glob("*.text"):
+                with cache_file.open("r") as f:
+                    batch[cache_file.stem] = f.read()
+                if len(batch) >= batch_size:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO tweets (tweet_id, text) VALUES (?, ?)", batch.items()
+                    )
+                    count, batch = count + len(batch), {}
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tweets (tweet_id, text) VALUES (?, ?)", batch.items()
+            )
+            count += len(batch)
+
+            self.connection.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, str(count)))
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        return count
+
+    def migrated(self, key):
+        return self.connection.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone() is not None
@@ -0,0 +1,87 @@
+import os
+import time
+
+from tqdm.auto import tqdm
+
+
+class RateLimitTracker:
+    """Paces requests by the rate limit headers of the Twitter API instead of fixed sleeps."""
+
+    def __init__(self):
+        self.remaining = None
+        self.reset_at = None
+
+    def update(self, headers):
+        if "x-rate-limit-remaining" in headers:
+            self.remaining = int(headers["x-rate-limit-remaining"])
+        if "x-rate-limit-reset" in headers:
+            self.reset_at = float(headers["x-rate-limit-reset"])
+
+    def wait(self):
+        if self.remaining == 0 and self.reset_at is not None:
+            delay = self.reset_at - time.time() + 1
+            if delay > 0:
+                print(f"Rate limit reached. Sleeping for {delay:.0f} seconds.")
+                time.sleep(delay)
+            self.remaining = None
+
+
+class TweetHydrator:
+    """Fetches tweet texts by id, 100 ids per request, and keeps them in a `TweetStore`."""
+
+    batch_size = 100
+
+    def __init__(self, store, client=None):
+        self.store = store
+        self._client = client
+        self.rate_limit = RateLimitTracker()
+
+    @property
+    def client(self):
+        # check if tweeter client is initialized
+        if self._client is None:
+            import requests
+            import tweepy as tw
+
+            barier_token = os.environ.get("TWITTER_API_BEARER_TOKEN")
+            assert barier_token is not None, "TWITTER_API_BEARER_TOKEN is not set"
+
+            # raw responses expose the rate limit headers
+            self._client = tw.Client(bearer_token=barier_token, return_type=requests.Response)
+        return self._client
+
+    def fetch(self, tweet_ids):
+        import tweepy.errors as tw_errors
+
+        while True:
+            self.rate_limit.wait()
+            try:
+                response = self.client.get_tweets(ids=tweet_ids)
+            except tw_errors.TooManyRequests as e:
+                response = e.response
+
+            self.rate_limit.update(response.headers)
+            if response.status_code == 429:
+                # wait() sleeps until the reset reported by the headers; without one, back off a minute
+                self.rate_limit.remaining = 0
+                if self.rate_limit.reset_at is None or self.rate_limit.reset_at <= time.time():
+                    self.rate_limit.reset_at = time.time() + 60
+                continue
+            response.raise_for_status()
+
+            # deleted or protected tweets are reported in `errors` and hydrate to an empty text
+            found = {tweet["id"]: tweet["text"] for tweet in response.json().get("data", [])}
+            return {tweet_id: found.get(tweet_id, "") for tweet_id in tweet_ids}
+
+    def hydrate(self, tweet_ids):
+        """Return {tweet_id: text} for all ids, fetching only those that are not cached yet."""
+        tweet_ids = list(dict.fromkeys(str(tweet_id) for tweet_id in tweet_ids))
+        texts = self.store.get_many(tweet_ids)
+
+        uncached = [tweet_id for tweet_id in tweet_ids if tweet_id not in texts]
+        for start in tqdm(range(0, len(uncached), self.batch_size), desc="Hydrating tweets"):
+            fetched = self.fetch(uncached[start : start + self.batch_size])
+            self.store.put_many(fetched)
+            texts.update(fetched)
+
+        return texts
@@ -1,12 +1,13 @@
 import os
-import time
 from pathlib import Path
 
 import datasets
 import pandas as pd
-from tqdm.auto import tqdm
+import pyarrow as pa
 
-tqdm.pandas()
+from .labels import encode_labels
+from .tweet_store import TweetStore
+from .twitter import TweetHydrator
 
 _CITATION = """\
 @inproceedings{conforti-etal-2020-will,
@@ -42,7 +43,7 @@ _URLS = {
 }
 
 
-class WTWT(datasets.GeneratorBasedBuilder):
+class WTWT(datasets.ArrowBasedBuilder):
     """Stance detection on tweets."""
 
     VERSION = datasets.Version("1.0.0")
@@ -105,59 +106,29 @@ class WTWT(datasets.GeneratorBasedBuilder):
             ),
         ]
 
-    def get_tweet_by_id(self, tweet_id):
-        try:
-            CACHE_FILE = self.TWEETER_CACHE / f"{tweet_id}.text"
-            # check if tweet is cached
-            if CACHE_FILE.exists():
-                with CACHE_FILE.open("r") as f:
-                    text = f.read()
-            else:
-                # check if tweeter client is initialized
-                if self.twitter_client is None:
-                    import tweepy as tw
-                    import tweepy.errors as tw_errors
-
-                    barier_token = os.environ.get("TWITTER_API_BEARER_TOKEN")
-                    assert barier_token is not None, "TWITTER_API_BEARER_TOKEN is not set"
-
-                    self.twitter_client = tw.Client(bearer_token=self.barier_token)
-
-                tweet = self.twitter_client.get_tweet(tweet_id)
-                text = tweet.data.text if tweet.data else ""
-                time.sleep(3)
-
-                # cache tweet
-                CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
-                with CACHE_FILE.open("w") as f:
-                    f.write(text)
-
-            return text
-        except tw_errors.TweepyException as e:
-            if e.response.status_code == 429:
-                # Rate limit reached, wait for 15 minutes before trying again
-                print(f"Rate limit reached. Sleeping for {60} seconds.")
-                time.sleep(60)
-                return self.get_tweet_by_id(tweet_id)
-
-    def _generate_examples(self, filepath, split):
+    def _generate_tables(self, filepath, split):
         _reader = pd.read_json(filepath, orient="records")
 
         # rename columns
         _reader = _reader.rename(columns={"stance": "label"})
 
         # get tweet text
-        _reader["text"] = _reader["tweet_id"].progress_apply(self.get_tweet_by_id)
+        _reader["tweet_id"] = _reader["tweet_id"].astype(str)
+        store = TweetStore(self.TWEETER_CACHE / "tweets.sqlite")
+        store.migrate_from_dir(self.TWEETER_CACHE)
+        texts = TweetHydrator(store, client=self.twitter_client).hydrate(_reader["tweet_id"])
+        _reader["text"] = _reader["tweet_id"].map(texts)
 
         # convert label to int
-        _reader["label"] = _reader["label"].apply(self.stance_labels.str2int)
+        _reader["label"] = encode_labels(_reader["label"], self.stance_labels)
 
         # add target
-        _reader["target"] = _reader["merger"].apply(
-            lambda x: "{buyer} wants to buy {target}".format_map(self.ma_operations[x])
-            if x in self.ma_operations
-            else ""
-        )
-
-        for id, row in _reader.iterrows():
-            yield id, row.to_dict()
+        targets = {
+            merger: "{buyer} wants to buy {target}".format_map(operation)
+            for merger, operation in self.ma_operations.items()
+        }
+        _reader["target"] = _reader["merger"].map(targets).fillna("")
+
+        table = pa.Table.from_pandas(_reader[list(self.info.features)], preserve_index=False)
+        for id, batch in enumerate(table.to_batches(max_chunksize=10000)):
+            yield id, pa.Table.from_batches([batch])
@@ -0,0 +1,58 @@
+import multiprocessing
+import os
+
+# set in each worker process: the model it generates with and the parameters to build it from
+_worker = {}
+# the parent's model, inherited by forked workers
+_inherited_llm = None
+
+
+def _init_worker(build_params, llm_params, num_threads):
+    import torch
+
+    # replicas split the cores instead of each one spawning a thread per core
+    torch.set_num_threads(num_threads)
+    _worker["build_params"] = build_params
+    _worker["llm_params"] = llm_params
+
+
+def _complete(task):
+    from src.backends import build_llm
+    from src.inference import sample_completions
+
+    if "llm" not in _worker:
+        # the model is only loaded by a worker that did not inherit it from the parent process
+        _worker["llm"] = _inherited_llm or build_llm("hf", **_worker["build_params"])
+    prompt_text, n = task
+    return sample_completions(_worker["llm"], prompt_text, n, _worker["llm_params"])
+
+
+class WorkerPool:
+    """Model replicas in `num_workers` processes that draw prompts from a shared queue.
+
+    Where processes are forked, the workers inherit the parent's model and share its weights
+    copy-on-write; otherwise every worker loads the model on its first prompt. Completions are
+    returned in the order of the prompts, `n` per prompt from one generate call.
+    """
+
+    def __init__(self, model_id, llm_params, num_workers, num_threads=None, llm=None):
+        global _inherited_llm
+
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        if start_method == "fork":
+            _inherited_llm = llm
+        self.pool = multiprocessing.get_context(start_method).Pool(
+            num_workers,
+            initializer=_init_worker,
+            initargs=({"model_id": model_id, **llm_params}, llm_params, num_threads),
+        )
+        _inherited_llm = None
+
+    def run(self, prompt_texts, n):
+        # chunksize 1: a free worker takes the next prompt, so long generations do not hold up a chunk
+        return list(self.pool.imap(_complete, [(prompt_text, n) for prompt_text in prompt_texts], chunksize=1))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()